@@ -123,12 +123,13 @@ class AttendanceController extends Controller
                 ], 400);
             }
 
-            // Face recognition
-            $faceResult = $this->faceService->recognizeFace($request->photo);
+            // Face verification against the authenticated user's templates only
+            $faceResult = $this->faceService->verifyFace($user->id, $request->photo);
 
             if (!$faceResult['success']) {
-                Log::warning('Face recognition failed for attendance', [
+                Log::warning('Face verification failed for attendance', [
                     'user_id' => $user->id,
+                    'distance' => $faceResult['distance'] ?? null,
                     'error' => $faceResult['message']
                 ]);
 
@@ -138,19 +139,6 @@ class AttendanceController extends Controller
                 ], 400);
             }
 
-            // Verify recognized user matches authenticated user
-            if ($faceResult['user_id'] != $user->id) {
-                Log::warning('Face mismatch in attendance', [
-                    'authenticated_user' => $user->id,
-                    'recognized_user' => $faceResult['user_id']
-                ]);
-
-                return response()->json([
-                    'success' => false,
-                    'message' => 'Face recognition mismatch. Please try again.'
-                ], 400);
-            }
-
             // Validate location (office radius check)
             $officeLatitude = config('attendance.office_latitude', -6.2088);
             $officeLongitude = config('attendance.office_longitude', 106.8456);
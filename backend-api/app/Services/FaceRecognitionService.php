@@ -17,15 +17,16 @@ class FaceRecognitionService
     }
 
     /**
-     * Register a new face for a user
+     * Register a new face template for a user (replace drops existing templates)
      */
-    public function registerFace(int $userId, string $photoBase64): array
+    public function registerFace(int $userId, string $photoBase64, bool $replace = false): array
     {
         try {
             $response = Http::timeout($this->timeout)
                 ->post($this->baseUrl . '/register-face', [
                     'user_id' => $userId,
-                    'photo' => $photoBase64
+                    'photo' => $photoBase64,
+                    'replace' => $replace
                 ]);
 
             if ($response->successful()) {
@@ -130,6 +131,121 @@ class FaceRecognitionService
         }
     }
 
+    /**
+     * Verify that a photo shows the given user (1:1, only that user's templates)
+     */
+    public function verifyFace(int $userId, string $photoBase64): array
+    {
+        try {
+            $response = Http::timeout($this->timeout)
+                ->post($this->baseUrl . '/verify', [
+                    'user_id' => $userId,
+                    'photo' => $photoBase64
+                ]);
+
+            $data = $response->json();
+
+            if ($response->successful()) {
+                Log::info('Face verification completed', [
+                    'user_id' => $userId,
+                    'verified' => $data['verified'] ?? false,
+                    'distance' => $data['distance'] ?? null
+                ]);
+
+                $verified = $data['verified'] ?? false;
+
+                return [
+                    'success' => $verified,
+                    'verified' => $verified,
+                    'user_id' => $userId,
+                    'confidence' => $data['confidence'] ?? 0,
+                    'distance' => $data['distance'] ?? null,
+                    'message' => $verified
+                        ? 'Face verified successfully'
+                        : 'Face recognition mismatch. Please try again.'
+                ];
+            }
+
+            Log::error('Face verification failed', [
+                'status' => $response->status(),
+                'response' => $data
+            ]);
+
+            return [
+                'success' => false,
+                'verified' => false,
+                'message' => $response->status() === 404
+                    ? 'Face not recognized. Please register your face first.'
+                    : ($data['message'] ?? 'Face verification failed'),
+                'error' => $data
+            ];
+        } catch (\Exception $e) {
+            Log::error('Face verification service error', [
+                'error' => $e->getMessage()
+            ]);
+
+            return [
+                'success' => false,
+                'verified' => false,
+                'message' => 'Face recognition service unavailable. Please try again later.',
+                'error' => $e->getMessage()
+            ];
+        }
+    }
+
+    /**
+     * Recognize many photos in a single request (e.g. offline kiosk queues)
+     *
+     * @param array $photos list of ['id' => mixed, 'photo' => base64 string]
+     */
+    public function recognizeBatch(array $photos): array
+    {
+        try {
+            $response = Http::timeout($this->timeout)
+                ->post($this->baseUrl . '/recognize-batch', [
+                    'photos' => array_values($photos)
+                ]);
+
+            if ($response->successful()) {
+                $data = $response->json();
+
+                Log::info('Batch face recognition completed', [
+                    'total' => $data['total'] ?? 0,
+                    'recognized' => $data['recognized'] ?? 0
+                ]);
+
+                return [
+                    'success' => true,
+                    'total' => $data['total'] ?? 0,
+                    'recognized' => $data['recognized'] ?? 0,
+                    'results' => $data['results'] ?? []
+                ];
+            }
+
+            $errorData = $response->json();
+            Log::error('Batch face recognition failed', [
+                'status' => $response->status(),
+                'response' => $errorData
+            ]);
+
+            return [
+                'success' => false,
+                'message' => $errorData['message'] ?? 'Batch face recognition failed',
+                'error' => $errorData
+            ];
+        } catch (\Exception $e) {
+            Log::error('Batch face recognition service error', [
+                'error' => $e->getMessage()
+            ]);
+
+            return [
+                'success' => false,
+                'message' => 'Face recognition service unavailable. Please try again later.',
+                'error' => $e->getMessage()
+            ];
+        }
+    }
+
     /**
      * Check the status of the face recognition service
      */
@@ -250,49 +366,110 @@ class FaceRecognitionService
     }
 
     /**
-     * Update face encoding for a user (re-register)
+     * Update face encoding for a user (re-register, replacing all templates)
      */
     public function updateFace(int $userId, string $photoBase64): array
     {
-        // First delete existing face data
-        $deleteResult = $this->deleteFace($userId);
+        return $this->registerFace($userId, $photoBase64, true);
+    }
+
+    /**
+     * Queue many registrations as one background enrollment job
+     *
+     * @param array $faces list of ['user_id' => int, 'photo' => base64 string, 'replace' => bool]
+     */
+    public function submitEnrollmentJob(array $faces): array
+    {
+        try {
+            $response = Http::timeout($this->timeout)
+                ->post($this->baseUrl . '/enroll-jobs', [
+                    'faces' => array_values($faces)
+                ]);
 
-        if (!$deleteResult['success']) {
-            // Continue anyway, maybe face data didn't exist
-            Log::warning('Could not delete existing face data, proceeding with registration', [
-                'user_id' => $userId
+            $data = $response->json();
+
+            if ($response->status() === 202) {
+                Log::info('Enrollment job submitted', [
+                    'job_id' => $data['job_id'] ?? null,
+                    'total' => $data['total'] ?? 0
+                ]);
+
+                return [
+                    'success' => true,
+                    'job_id' => $data['job_id'],
+                    'status' => $data['status'] ?? 'queued',
+                    'total' => $data['total'] ?? count($faces)
+                ];
+            }
+
+            Log::error('Enrollment job submission failed', [
+                'status' => $response->status(),
+                'response' => $data
+            ]);
+
+            return [
+                'success' => false,
+                'message' => $data['message'] ?? 'Enrollment job submission failed',
+                'error' => $data
+            ];
+        } catch (\Exception $e) {
+            Log::error('Enrollment job service error', [
+                'error' => $e->getMessage()
             ]);
-        }
 
-        // Register new face
-        return $this->registerFace($userId, $photoBase64);
+            return [
+                'success' => false,
+                'message' => 'Face recognition service unavailable. Please try again later.',
+                'error' => $e->getMessage()
+            ];
+        }
     }
 
     /**
-     * Batch process multiple faces (for testing or migration)
+     * Get progress of an enrollment job, including the outcome per user
      */
-    public function batchProcess(array $faces): array
+    public function getEnrollmentJob(string $jobId): array
     {
-        $results = [];
-        $successful = 0;
-        $failed = 0;
-
-        foreach ($faces as $face) {
-            $result = $this->registerFace($face['user_id'], $face['photo']);
-            $results[] = $result;
-
-            if ($result['success']) {
-                $successful++;
-            } else {
-                $failed++;
+        try {
+            $response = Http::timeout($this->timeout)
+                ->get($this->baseUrl . '/enroll-jobs/' . $jobId);
+
+            if ($response->successful()) {
+                return [
+                    'success' => true,
+                    'job' => $response->json()['job'] ?? []
+                ];
             }
+
+            return [
+                'success' => false,
+                'message' => $response->json()['message'] ?? 'Enrollment job not found'
+            ];
+        } catch (\Exception $e) {
+            Log::error('Enrollment job status error', [
+                'job_id' => $jobId,
+                'error' => $e->getMessage()
+            ]);
+
+            return [
+                'success' => false,
+                'message' => 'Face recognition service unavailable. Please try again later.',
+                'error' => $e->getMessage()
+            ];
         }
+    }
+
+    /**
+     * Batch register faces as a background enrollment job
+     *
+     * Returns immediately with a job id; poll getEnrollmentJob() for per-user results.
+     */
+    public function batchProcess(array $faces): array
+    {
+        $job = $this->submitEnrollmentJob($faces);
 
-        return [
-            'total' => count($faces),
-            'successful' => $successful,
-            'failed' => $failed,
-            'results' => $results
-        ];
+        return array_merge([
+            'total' => count($faces)
+        ], $job);
     }
 }
@@ -5,19 +5,43 @@ Python Flask API using face_recognition library
 """
 
 import os
+import re
 import json
+import queue
+import uuid
 import base64
+import hashlib
 import logging
+import threading
+import time
 import traceback
+import weakref
+import zlib
+from bisect import bisect_left
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
 from datetime import datetime, timedelta
 from io import BytesIO
 import numpy as np
-from PIL import Image
-import face_recognition
-from flask import Flask, request, jsonify
+import requests
+from PIL import Image, ImageOps
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
 from dotenv import load_dotenv
 
+try:
+    import fcntl
+except ImportError:  # Windows: gallery writes are only serialised per process
+    fcntl = None
+
+try:
+    import cv2
+except ImportError:  # only needed for the cascade detector
+    cv2 = None
+
 # Load environment variables
 load_dotenv()
 
@@ -28,15 +52,63 @@ CORS(app)
 app.config['FACE_DATA_DIR'] = os.getenv('FACE_DATA_DIR', './face_data')
 app.config['LOG_LEVEL'] = os.getenv('LOG_LEVEL', 'INFO')
 app.config['MAX_FACES_PER_USER'] = int(os.getenv('MAX_FACES_PER_USER', '5'))
+app.config['TEMPLATE_REPLACE_POLICY'] = os.getenv('TEMPLATE_REPLACE_POLICY', 'oldest')
+app.config['TEMPLATE_AGGREGATION'] = os.getenv('TEMPLATE_AGGREGATION', 'min')
 app.config['RECOGNITION_TOLERANCE'] = float(os.getenv('RECOGNITION_TOLERANCE', '0.6'))
 app.config['FACE_QUALITY_THRESHOLD'] = float(os.getenv('FACE_QUALITY_THRESHOLD', '0.8'))
+app.config['RECOGNITION_QUALITY_THRESHOLD'] = float(os.getenv('RECOGNITION_QUALITY_THRESHOLD', '0.4'))
+app.config['GALLERY_DTYPE'] = os.getenv('GALLERY_DTYPE', 'float64')
+app.config['GALLERY_INDEX'] = os.getenv('GALLERY_INDEX', 'exact')
+app.config['GALLERY_QUANTIZE'] = os.getenv('GALLERY_QUANTIZE', 'none')
+app.config['QUANTIZE_RERANK'] = int(os.getenv('QUANTIZE_RERANK', '64'))
+app.config['INDEX_NLIST'] = int(os.getenv('INDEX_NLIST', '256'))
+app.config['INDEX_NPROBE'] = int(os.getenv('INDEX_NPROBE', '8'))
+app.config['INDEX_MIN_SIZE'] = int(os.getenv('INDEX_MIN_SIZE', '10000'))
+app.config['GALLERY_COMPACT_THRESHOLD'] = float(os.getenv('GALLERY_COMPACT_THRESHOLD', '0.25'))
+app.config['BATCH_MAX_IMAGES'] = int(os.getenv('BATCH_MAX_IMAGES', '32'))
+app.config['STATUS_MAX_USERS'] = int(os.getenv('STATUS_MAX_USERS', '1000'))
+app.config['MAX_TOP_K'] = int(os.getenv('MAX_TOP_K', '10'))
+app.config['GROUP_MAX_FACES'] = int(os.getenv('GROUP_MAX_FACES', '10'))
+app.config['STREAM_MAX_FRAMES'] = int(os.getenv('STREAM_MAX_FRAMES', '600'))
+app.config['STREAM_MIN_FRAMES'] = int(os.getenv('STREAM_MIN_FRAMES', '3'))
+app.config['STREAM_DETECT_INTERVAL'] = int(os.getenv('STREAM_DETECT_INTERVAL', '1'))
+app.config['STREAM_REENCODE_INTERVAL'] = int(os.getenv('STREAM_REENCODE_INTERVAL', '10'))
+app.config['MAX_IMAGE_SIZE'] = int(os.getenv('MAX_IMAGE_SIZE', '2097152'))
+app.config['DECODE_MAX_SIZE'] = int(os.getenv('DECODE_MAX_SIZE', '1600'))
+app.config['DETECT_MAX_SIZE'] = int(os.getenv('DETECT_MAX_SIZE', '640'))
+app.config['ENROLL_DETECTOR'] = os.getenv('ENROLL_DETECTOR', 'hog')
+app.config['ENROLL_UPSAMPLE'] = int(os.getenv('ENROLL_UPSAMPLE', '1'))
+app.config['ENROLL_JITTERS'] = int(os.getenv('ENROLL_JITTERS', '5'))
+app.config['RECOGNIZE_DETECTOR'] = os.getenv('RECOGNIZE_DETECTOR', 'hog')
+app.config['RECOGNIZE_UPSAMPLE'] = int(os.getenv('RECOGNIZE_UPSAMPLE', '1'))
+app.config['RECOGNIZE_JITTERS'] = int(os.getenv('RECOGNIZE_JITTERS', '1'))
+app.config['BATCH_THREADS'] = int(os.getenv('BATCH_THREADS', str(os.cpu_count() or 4)))
+app.config['MAX_WORKERS'] = int(os.getenv('MAX_WORKERS', '4'))
+app.config['WORKER_TIMEOUT'] = float(os.getenv('WORKER_TIMEOUT', '30'))
+app.config['INFERENCE_QUEUE_SIZE'] = int(os.getenv('INFERENCE_QUEUE_SIZE', '8'))
+app.config['CACHE_TIMEOUT'] = int(os.getenv('CACHE_TIMEOUT', '3600'))
+app.config['CACHE_MAX_ENTRIES'] = int(os.getenv('CACHE_MAX_ENTRIES', '1024'))
+app.config['REDIS_URL'] = os.getenv('REDIS_URL', '')
+app.config['GALLERY_SYNC'] = os.getenv('GALLERY_SYNC', 'true').lower() == 'true'
+app.config['GROUP_COMMIT_WINDOW_MS'] = float(os.getenv('GROUP_COMMIT_WINDOW_MS', '0'))
+app.config['ENROLL_WORKERS'] = int(os.getenv('ENROLL_WORKERS', '1'))
+app.config['ENROLL_QUEUE_SIZE'] = int(os.getenv('ENROLL_QUEUE_SIZE', '16'))
+app.config['ENROLL_BATCH_SIZE'] = int(os.getenv('ENROLL_BATCH_SIZE', '32'))
+app.config['ENROLL_MAX_FACES'] = int(os.getenv('ENROLL_MAX_FACES', '500'))
+app.config['ENROLL_JOB_TTL'] = int(os.getenv('ENROLL_JOB_TTL', '86400'))
+app.config['STARTUP_MODE'] = os.getenv('STARTUP_MODE', 'eager')
+app.config['SHARD_ID'] = int(os.getenv('SHARD_ID', '0'))
+app.config['SHARD_COUNT'] = int(os.getenv('SHARD_COUNT', '1'))
+app.config['SHARD_URLS'] = [url.strip() for url in os.getenv('SHARD_URLS', '').split(',') if url.strip()]
+app.config['SHARD_TIMEOUT'] = float(os.getenv('SHARD_TIMEOUT', '2'))
 
 # Setup logging
 logging.basicConfig(
     level=getattr(logging, app.config['LOG_LEVEL']),
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     handlers=[
-        logging.FileHandler('face_server.log'),
+        # The log file is only opened by the first record written to it
+        logging.FileHandler('face_server.log', delay=True),
         logging.StreamHandler()
     ]
 )
@@ -45,172 +117,2876 @@ logger = logging.getLogger(__name__)
 # Create face data directory if it doesn't exist
 os.makedirs(app.config['FACE_DATA_DIR'], exist_ok=True)
 
+# face_recognition loads the dlib models when imported, so it is imported on first use
+face_recognition = None
+face_recognition_lock = threading.Lock()
+
+# Objects whose locks a thread of the parent (e.g. the startup thread) may hold
+# when a worker is forked; the child gets them back unlocked
+fork_safe_objects = weakref.WeakSet()
+
+def reset_locks_after_fork():
+    global face_recognition_lock
+    face_recognition_lock = threading.Lock()
+    for obj in list(fork_safe_objects):
+        obj.after_fork()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_locks_after_fork)
+
+def load_face_recognition():
+    """Import face_recognition and its dlib models once per process"""
+    global face_recognition
+    if face_recognition is None:
+        with face_recognition_lock:
+            if face_recognition is None:
+                import face_recognition as module
+                face_recognition = module
+    return face_recognition
+
+class ExactIndex:
+    """Brute-force search: every gallery row is a candidate"""
+
+    name = 'exact'
+
+    @property
+    def ready(self):
+        return False
+
+    def needs_training(self, size):
+        return False
+
+    def fit(self, matrix):
+        return None
+
+    def use_centroids(self, centroids, matrix, rows):
+        pass
+
+    def reset(self):
+        pass
+
+    def add(self, row, encoding):
+        pass
+
+    def remove(self, row):
+        pass
+
+    def candidates(self, encoding):
+        return None
+
+    def save(self, path):
+        pass
+
+    def load(self, path, matrix, rows):
+        return False
+
+class IVFIndex:
+    """Inverted-file index: k-means centroids partition gallery rows into lists
+
+    A query only scores the rows in the `nprobe` lists whose centroids are
+    closest, so raising `nprobe` trades latency for recall.
+    """
+
+    name = 'ivf'
+
+    def __init__(self, nlist=256, nprobe=8, iterations=10, seed=0):
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.iterations = iterations
+        self.seed = seed
+        self.centroids = None
+        self.centroid_norms = None
+        self.trained_size = 0
+        self.lists = []
+        self.assignments = {}
+
+    @property
+    def ready(self):
+        return self.centroids is not None
+
+    def needs_training(self, size):
+        """Train once, then retrain whenever the gallery has doubled since"""
+        return not self.ready or size >= 2 * self.trained_size
+
+    @staticmethod
+    def _squared_distances(vectors, centroids, centroid_norms):
+        return (
+            np.einsum('ij,ij->i', vectors, vectors)[:, None]
+            + centroid_norms[None, :]
+            - 2 * (vectors @ centroids.T)
+        )
+
+    def _nearest_centroids(self, vectors, count=1):
+        """Return the `count` nearest centroid ids for each row of `vectors`"""
+        vectors = np.atleast_2d(vectors)
+        squared = self._squared_distances(vectors, self.centroids, self.centroid_norms)
+        if count >= squared.shape[1]:
+            return np.argsort(squared, axis=1)
+        nearest = np.argpartition(squared, count - 1, axis=1)[:, :count]
+        order = np.take_along_axis(squared, nearest, axis=1).argsort(axis=1)
+        return np.take_along_axis(nearest, order, axis=1)
+
+    def _set_centroids(self, centroids):
+        self.centroids = np.ascontiguousarray(centroids)
+        self.centroid_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        self.lists = [set() for _ in range(len(self.centroids))]
+        self.list_arrays = {}
+        self.assignments = {}
+
+    def fit(self, matrix):
+        """Run k-means over a sample of `matrix` and return the centroids
+
+        Does not touch the index state, so it can run outside the gallery lock.
+        """
+        size = len(matrix)
+        nlist = max(1, min(self.nlist, size // 39 or 1))
+        rng = np.random.default_rng(self.seed)
+
+        sample = matrix
+        if size > nlist * 64:
+            sample = matrix[rng.choice(size, nlist * 64, replace=False)]
+        sample = np.asarray(sample, dtype=np.float64)
+
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(self.iterations):
+            squared = self._squared_distances(sample, centroids, np.einsum('ij,ij->i', centroids, centroids))
+            labels = squared.argmin(axis=1)
+            counts = np.bincount(labels, minlength=nlist)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+
+            filled = counts > 0
+            centroids[filled] = sums[filled] / counts[filled, None]
+            # Re-seed empty lists from random sample points
+            empty = np.flatnonzero(~filled)
+            if len(empty):
+                centroids[empty] = sample[rng.choice(len(sample), len(empty))]
+
+        return centroids
+
+    def use_centroids(self, centroids, matrix, rows):
+        """Switch to a new set of centroids and reassign the given rows"""
+        self._set_centroids(centroids)
+        self.trained_size = len(rows)
+        self.assign_all(matrix, rows)
+
+    def assign_all(self, matrix, rows):
+        """Assign the given gallery rows to their nearest centroid"""
+        self.reset()
+        for start in range(0, len(rows), 8192):
+            block_rows = rows[start:start + 8192]
+            block = np.asarray(matrix[block_rows], dtype=np.float64)
+            labels = self._nearest_centroids(block)[:, 0]
+            for row, label in zip(block_rows.tolist(), labels.tolist()):
+                self.lists[label].add(row)
+                self.assignments[row] = label
+
+    def reset(self):
+        self.lists = [set() for _ in range(len(self.lists))]
+        self.list_arrays = {}
+        self.assignments = {}
+
+    def add(self, row, encoding):
+        if not self.ready:
+            return
+        label = int(self._nearest_centroids(np.asarray(encoding, dtype=np.float64))[0, 0])
+        self.lists[label].add(row)
+        self.list_arrays.pop(label, None)
+        self.assignments[row] = label
+
+    def remove(self, row):
+        label = self.assignments.pop(row, None)
+        if label is not None:
+            self.lists[label].discard(row)
+            self.list_arrays.pop(label, None)
+
+    def _list_array(self, label):
+        """Row ids of one list as an array, cached until the list changes"""
+        rows = self.list_arrays.get(label)
+        if rows is None:
+            rows = np.fromiter(self.lists[label], dtype=np.int64, count=len(self.lists[label]))
+            self.list_arrays[label] = rows
+        return rows
+
+    def candidates(self, encoding):
+        """Return the gallery rows stored in the `nprobe` closest lists"""
+        if not self.ready:
+            return None
+        probes = self._nearest_centroids(np.asarray(encoding, dtype=np.float64), self.nprobe)[0]
+        return np.concatenate([self._list_array(label) for label in probes])
+
+    def save(self, path):
+        """Persist the trained centroids so startup only has to assign rows"""
+        if not self.ready:
+            return
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(tmp_path, centroids=self.centroids)
+        os.replace(tmp_path, path)
+
+    def load(self, path, matrix, rows):
+        """Load persisted centroids and assign the gallery rows to them"""
+        if not os.path.exists(path):
+            return False
+        with np.load(path) as data:
+            centroids = data['centroids']
+        if centroids.ndim != 2 or centroids.shape[1] != matrix.shape[1]:
+            return False
+        self.use_centroids(centroids, matrix, rows)
+        return True
+
+def create_index(kind, nlist=256, nprobe=8):
+    """Build the gallery index selected by GALLERY_INDEX"""
+    if kind == 'ivf':
+        return IVFIndex(nlist=nlist, nprobe=nprobe)
+    if kind != 'exact':
+        logger.warning(f"Unknown gallery index '{kind}', falling back to exact search")
+    return ExactIndex()
+
+class VectorQuantizer:
+    """Packed low-precision copy of the gallery for a cheap first matching pass
+
+    `float16` stores two bytes per component; `int8` stores one byte per
+    component plus a float32 scale per vector (max |value| / 127). Distances
+    on the packed copy only choose the `rerank` nearest rows per query; the
+    users owning them are then ranked on the exact encodings, which keeps
+    the rest of the mmap'd matrix out of memory.
+    """
+
+    def __init__(self, kind='int8', dimensions=128, rerank=64, chunk=16384):
+        self.name = kind
+        self.dimensions = dimensions
+        self.rerank = rerank
+        self.chunk = chunk
+        self.dtype = np.dtype(np.int8 if kind == 'int8' else np.float16)
+        self.reset()
+
+    def reset(self):
+        # Always replaced, never cleared in place: searches may hold the old arrays
+        self.codes = np.zeros((0, self.dimensions), dtype=self.dtype)
+        self.scales = np.zeros(0, dtype=np.float32)
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (self.scales.nbytes if self.name == 'int8' else 0)
+
+    def encode(self, start, vectors):
+        """Quantize rows [start, start + len(vectors))"""
+        end = start + len(vectors)
+        if len(self.codes) < end:
+            capacity = max(end, 2 * len(self.codes))
+            codes = np.zeros((capacity, self.dimensions), dtype=self.dtype)
+            codes[:len(self.codes)] = self.codes
+            scales = np.ones(capacity, dtype=np.float32)
+            scales[:len(self.scales)] = self.scales
+            self.codes, self.scales = codes, scales
+
+        block = np.asarray(vectors, dtype=np.float32)
+        if self.name == 'int8':
+            scales = np.abs(block).max(axis=1) / 127
+            scales[scales == 0] = 1
+            self.codes[start:end] = np.rint(block / scales[:, None])
+            self.scales[start:end] = scales
+        else:
+            self.codes[start:end] = block
+
+    def dots(self, size, queries):
+        """Approximate dot products of the first `size` rows with each query, as (size, queries)"""
+        codes, scales = self.codes, self.scales
+        queries = np.asarray(queries, dtype=np.float32)
+        dots = np.empty((size, len(queries)), dtype=np.float32)
+        # Chunked so only a slice of the codes is widened to float32 at a time
+        for start in range(0, size, self.chunk):
+            end = min(size, start + self.chunk)
+            dots[start:end] = codes[start:end].astype(np.float32) @ queries.T
+            if self.name == 'int8':
+                dots[start:end] *= scales[start:end, None]
+        return dots
+
+    def describe(self):
+        return {'type': self.name, 'rerank': self.rerank, 'bytes': self.nbytes}
+
+def create_quantizer(kind, rerank=64):
+    """Build the first-pass quantizer selected by GALLERY_QUANTIZE, or None"""
+    if kind in ('int8', 'float16'):
+        return VectorQuantizer(kind, rerank=rerank)
+    if kind != 'none':
+        logger.warning(f"Unknown gallery quantization '{kind}', matching on exact encodings only")
+    return None
+
+GALLERY_FORMAT_VERSION = 1
+
+def fsync_directory(path):
+    """fsync a directory so renames and newly created files in it survive a crash"""
+    if not hasattr(os, 'O_DIRECTORY'):
+        return
+    fd = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+# One fixed-size record per gallery row, stored next to the encoding matrix
+GALLERY_RECORD = np.dtype([
+    ('user_id', 'S32'),
+    ('deleted', 'u1'),
+    ('registered_at', '<f8'),
+    ('quality', '<f4'),
+    ('norm', '<f8'),
+])
+
+def user_id_error(user_id):
+    """Why a user id does not fit the fixed-width GALLERY_RECORD field, or None"""
+    limit = GALLERY_RECORD['user_id'].itemsize
+    if len(str(user_id).encode()) > limit:
+        return f"user_id too long: maximum {limit} bytes (UTF-8)"
+    return None
+
+class FaceGallery:
+    """Append-only, memory-mapped matrix of face encodings
+
+    Files in `data_dir`:
+      gallery.json        - header (format version, dtype, dimensions, generation)
+      gallery-<gen>.vec   - raw encodings, one row per template, append-only
+      gallery-<gen>.ids   - one GALLERY_RECORD per row (user id, tombstone, metadata)
+      gallery-<gen>.del   - append-only journal of tombstoned row numbers
+      gallery.seq         - change counter bumped by every write
+
+    Every worker maps the same files, so encodings live once in the page cache
+    and opening the gallery does not read them. Deletes only flip the row's
+    tombstone byte; `compact` rewrites the live rows into a new generation and
+    switches to it by atomically replacing the header.
+
+    Other workers notice writes by comparing the mapped change counter with
+    the value they last saw, then apply only the appended rows and the new
+    journal entries (or reopen, if the generation changed).
+
+    Writes are crash-safe without a separate log: the header is the only
+    manifest, encodings are written (and, with `sync`, fsynced) before their
+    records, and a row only exists once both are complete. On startup
+    `_recover` cuts any torn tail and deletes files of abandoned generations.
+
+    With a `quantizer`, a packed float16/int8 copy of the rows is kept in
+    memory and exact scans score it first, re-ranking only the closest users.
+    """
+
+    def __init__(self, data_dir, dimensions=128, dtype='float64', index=None, index_min_size=10000,
+                 quantizer=None, autoload=True):
+        self.data_dir = data_dir
+        self.header_path = os.path.join(data_dir, 'gallery.json')
+        self.lock_path = os.path.join(data_dir, 'gallery.lock')
+        self.sequence_path = os.path.join(data_dir, 'gallery.seq')
+        self.dimensions = dimensions
+        self.dtype = np.dtype(dtype)
+        self.generation = 0
+        self.index = index or ExactIndex()
+        self.index_min_size = index_min_size
+        self.quantizer = quantizer
+        # Persisted index file and the (mtime, size) of the version applied here
+        self.index_path = None
+        self.index_stamp = None
+        self.lock = threading.RLock()
+        # Open handles of file_lock, closed by a forked child that inherited them
+        self.lock_handles = []
+        fork_safe_objects.add(self)
+        self.size = 0
+        self.rows = {}
+        self.user_meta = {}
+        self._reset_slots()
+        self.deletions_read = 0
+        self.seen_sequence = 0
+        self.sequence = None
+        self._map(0)
+        if autoload:
+            self.open()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, user_id):
+        return str(user_id) in self.rows
+
+    @property
+    def template_count(self):
+        return int(np.count_nonzero(self.row_slots[:self.size] >= 0))
+
+    @property
+    def row_bytes(self):
+        return self.dimensions * self.dtype.itemsize
+
+    @property
+    def vectors_path(self):
+        return os.path.join(self.data_dir, f"gallery-{self.generation}.vec")
+
+    @property
+    def records_path(self):
+        return os.path.join(self.data_dir, f"gallery-{self.generation}.ids")
+
+    @property
+    def deletions_path(self):
+        return os.path.join(self.data_dir, f"gallery-{self.generation}.del")
+
+    @property
+    def tombstones(self):
+        return self.size - self.template_count
+
+    @contextmanager
+    def file_lock(self, shared=False):
+        """Serialise writers across worker processes (no-op without fcntl)"""
+        with open(self.lock_path, 'a') as handle:
+            if fcntl:
+                fcntl.flock(handle, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            self.lock_handles.append(handle)
+            try:
+                yield
+            finally:
+                self.lock_handles.remove(handle)
+                if fcntl:
+                    fcntl.flock(handle, fcntl.LOCK_UN)
+
+    def after_fork(self):
+        """Recreate the thread lock and drop inherited flock handles in a forked child
+
+        The flock stays with the parent, which still releases it normally; a
+        child that was forked mid-load reopens the gallery from scratch.
+        """
+        self.lock = threading.RLock()
+        for handle in self.lock_handles:
+            handle.close()
+        self.lock_handles = []
+
+    def _write_header(self):
+        header = {
+            'version': GALLERY_FORMAT_VERSION,
+            'dtype': self.dtype.name,
+            'dimensions': self.dimensions,
+            'generation': self.generation
+        }
+        tmp_path = f"{self.header_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(header, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.header_path)
+        fsync_directory(self.data_dir)
+
+    def _read_header(self):
+        """Load the on-disk format, creating it with the configured dtype if missing"""
+        if not os.path.exists(self.header_path):
+            self._write_header()
+            return
+
+        with open(self.header_path, 'r') as f:
+            header = json.load(f)
+
+        if header.get('version') != GALLERY_FORMAT_VERSION:
+            raise ValueError(f"Unsupported gallery format version: {header.get('version')}")
+
+        dtype = np.dtype(header['dtype'])
+        if dtype != self.dtype or header['dimensions'] != self.dimensions:
+            logger.warning(
+                f"Gallery on disk uses {dtype.name}x{header['dimensions']}, "
+                f"ignoring configured {self.dtype.name}x{self.dimensions}"
+            )
+        self.dtype = dtype
+        self.dimensions = header['dimensions']
+        self.generation = header['generation']
+
+    def _committed_rows(self):
+        """Rows present in both files; a torn tail from an interrupted append is ignored"""
+        vectors = os.path.getsize(self.vectors_path) // self.row_bytes
+        records = os.path.getsize(self.records_path) // GALLERY_RECORD.itemsize
+        return min(vectors, records)
+
+    def _map(self, size):
+        """Map the first `size` rows of the current generation"""
+        self.size = size
+        if len(self.row_slots) < size:
+            grown = np.full(max(size, 2 * len(self.row_slots)), -1, dtype=np.int64)
+            grown[:len(self.row_slots)] = self.row_slots
+            self.row_slots = grown
+
+        if size == 0:
+            self.matrix = np.zeros((0, self.dimensions), dtype=self.dtype)
+            self.records = np.zeros(0, dtype=GALLERY_RECORD)
+            self.norms = np.zeros(0)
+            return
+
+        self.matrix = np.memmap(self.vectors_path, dtype=self.dtype, mode='r', shape=(size, self.dimensions))
+        self.records = np.memmap(self.records_path, dtype=GALLERY_RECORD, mode='r', shape=(size,))
+        self.norms = np.array(self.records['norm'])
+
+    def _reset_slots(self):
+        """Forget the user slot table; rows are re-slotted by _apply_rows"""
+        self.slots = {}
+        self.slot_users = []
+        self.slot_norms = np.zeros(0)
+        self.row_slots = np.full(self.size, -1, dtype=np.int64)
+        self.full_grouping = None
+
+    def _slot(self, user_id):
+        """Dense per-user index used to aggregate template distances"""
+        slot = self.slots.get(user_id)
+        if slot is None:
+            slot = len(self.slot_users)
+            self.slots[user_id] = slot
+            self.slot_users.append(user_id)
+            if slot >= len(self.slot_norms):
+                grown = np.full(max(64, 2 * len(self.slot_norms)), np.nan)
+                grown[:len(self.slot_norms)] = self.slot_norms
+                self.slot_norms = grown
+        # The user's centroid changed and must be recomputed
+        self.slot_norms[slot] = np.nan
+        return slot
+
+    def _apply_rows(self, start, end, assign=True):
+        """Index rows [start, end) into the user id -> rows and user id -> metadata tables
+
+        With `assign=False` the rows are not added to the ANN index one by one;
+        the caller reassigns them all in one pass.
+        """
+        records = self.records[start:end]
+        if self.quantizer:
+            self.quantizer.encode(start, self.matrix[start:end])
+        for offset, (user_id, deleted, registered_at, quality) in enumerate(zip(
+                records['user_id'].tolist(), records['deleted'].tolist(),
+                records['registered_at'].tolist(), records['quality'].tolist())):
+            if deleted:
+                continue
+            row = start + offset
+            # A damaged id must not stop the rows after it from loading
+            user_id = user_id.decode(errors='replace')
+            self.rows.setdefault(user_id, []).append(row)
+            self._merge_meta(user_id, registered_at, quality)
+            self.row_slots[row] = self._slot(user_id)
+            self.full_grouping = None
+            if assign:
+                self.index.add(row, self.matrix[row])
+
+    def _merge_meta(self, user_id, registered_at, quality):
+        """Fold one template into the user's latest registration time and best quality"""
+        meta = self.user_meta.setdefault(user_id, [registered_at, None])
+        meta[0] = max(meta[0], registered_at)
+        if not np.isnan(quality):
+            meta[1] = quality if meta[1] is None else max(meta[1], quality)
+
+    def _drop_row(self, row, user_id):
+        """Forget one template row of a user"""
+        rows = self.rows.get(user_id)
+        if not rows or row not in rows:
+            return
+        rows.remove(row)
+        if not rows:
+            del self.rows[user_id]
+            self.user_meta.pop(user_id, None)
+        else:
+            # Only the user's remaining records are read back
+            records = self.records[rows]
+            self.user_meta[user_id] = [float(records['registered_at'].max()), None]
+            for quality in records['quality'].tolist():
+                self._merge_meta(user_id, self.user_meta[user_id][0], quality)
+        self.row_slots[row] = -1
+        self.full_grouping = None
+        self.slot_norms[self.slots[user_id]] = np.nan
+        self.index.remove(row)
+
+    def live_rows(self):
+        return np.flatnonzero(self.row_slots[:self.size] >= 0)
+
+    def _apply_deletions(self):
+        """Drop rows listed in the deletion journal since we last read it"""
+        with open(self.deletions_path, 'rb') as f:
+            f.seek(self.deletions_read * 8)
+            data = f.read()
+
+        rows = np.frombuffer(data[:len(data) // 8 * 8], dtype='<i8')
+        self.deletions_read += len(rows)
+        for row in rows.tolist():
+            if row >= self.size:
+                continue
+            self._drop_row(row, self.records[row]['user_id'].decode(errors='replace'))
+
+    def _open_files(self):
+        """Map the current generation from scratch; caller holds both locks"""
+        self._read_header()
+        for path in (self.vectors_path, self.records_path, self.deletions_path):
+            open(path, 'ab').close()
+
+        size = self._committed_rows()
+        self.rows = {}
+        self.user_meta = {}
+        self._reset_slots()
+        self._map(size)
+        self.index.reset()
+        if self.quantizer:
+            self.quantizer.reset()
+        # A trained index is reassigned below in one vectorised pass
+        self._apply_rows(0, size, assign=False)
+        # Rows already carry their tombstone flag, the journal is only for catching up
+        self.deletions_read = os.path.getsize(self.deletions_path) // 8
+
+        if self.index.ready:
+            self.index.use_centroids(self.index.centroids, self.matrix, self.live_rows())
+
+    def open(self):
+        """(Re)open the gallery files, discarding any partially written rows"""
+        with self.lock, self.file_lock():
+            if not os.path.exists(self.sequence_path):
+                with open(self.sequence_path, 'wb') as f:
+                    f.write(np.zeros(1, dtype='<i8').tobytes())
+            self.sequence = np.memmap(self.sequence_path, dtype='<i8', mode='r+', shape=(1,))
+
+            self._read_header()
+            self._recover()
+            self._open_files()
+            self.seen_sequence = int(self.sequence[0])
+
+    def _recover(self):
+        """Roll the files back to the last complete write; caller holds both locks"""
+        for path in (self.vectors_path, self.records_path, self.deletions_path):
+            open(path, 'ab').close()
+
+        size = self._committed_rows()
+        for path, length in (
+            (self.vectors_path, size * self.row_bytes),
+            (self.records_path, size * GALLERY_RECORD.itemsize),
+            (self.deletions_path, os.path.getsize(self.deletions_path) // 8 * 8),
+        ):
+            torn = os.path.getsize(path) - length
+            if torn:
+                logger.warning(f"Discarding {torn} bytes of an interrupted write from {os.path.basename(path)}")
+                os.truncate(path, length)
+
+        # Leftovers of a compaction that crashed before or after switching the header
+        current = re.compile(rf"gallery-{self.generation}\.(vec|ids|del)$")
+        for name in os.listdir(self.data_dir):
+            if name == 'gallery.json.tmp' or (re.match(r"gallery-\d+\.(vec|ids|del)$", name) and not current.match(name)):
+                logger.warning(f"Removing stale gallery file {name}")
+                os.remove(os.path.join(self.data_dir, name))
+
+    def _catch_up(self):
+        """Apply changes other workers made since we last looked; caller holds the locks"""
+        sequence = int(self.sequence[0])
+        if sequence == self.seen_sequence:
+            return False
+
+        generation = self.generation
+        self._read_header()
+        if self.generation != generation:
+            self._open_files()
+        else:
+            size = self._committed_rows()
+            if size > self.size:
+                previous_size = self.size
+                self._map(size)
+                self._apply_rows(previous_size, size)
+            self._apply_deletions()
+
+        # Another worker retrained and saved the index
+        if self.index_path and self._index_file_stamp() != self.index_stamp:
+            self._reload_index()
+
+        self.seen_sequence = sequence
+        return True
+
+    def _index_file_stamp(self):
+        try:
+            stat = os.stat(self.index_path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def _reload_index(self):
+        """Apply the index file saved by another worker; caller holds the locks"""
+        stamp = self._index_file_stamp()
+        try:
+            if self.index.load(self.index_path, self.matrix, self.live_rows()):
+                logger.info(f"Reloaded {self.index.name} index from {self.index_path}")
+        except Exception as e:
+            logger.error(f"Error reloading gallery index: {e}")
+        self.index_stamp = stamp
+
+    def _sync_files(self, paths=None):
+        """fsync the current generation's files, covering every write made before the call"""
+        for path in paths or (self.vectors_path, self.records_path, self.deletions_path):
+            if not os.path.exists(path):
+                continue
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def _bump_sequence(self):
+        """Publish a write to the other workers; caller holds the file lock"""
+        self.sequence[0] += 1
+        self.seen_sequence = int(self.sequence[0])
+
+    def refresh(self):
+        """Cheaply check the shared change counter and apply pending changes"""
+        if self.sequence is None or int(self.sequence[0]) == self.seen_sequence:
+            return False
+
+        with self.lock, self.file_lock(shared=True):
+            changed = self._catch_up()
+        if changed:
+            logger.info(f"Gallery refreshed from disk: {len(self.rows)} encodings")
+        return changed
+
+    def _tombstone(self, row):
+        with open(self.records_path, 'r+b') as f:
+            f.seek(row * GALLERY_RECORD.itemsize + GALLERY_RECORD.fields['deleted'][1])
+            f.write(b'\x01')
+        with open(self.deletions_path, 'ab') as f:
+            f.write(np.array([row], dtype='<i8').tobytes())
+        # Our own journal entries are already applied
+        self.deletions_read += 1
+
+    def _eviction_order(self, rows, policy):
+        """Sort a user's template rows so the first ones are evicted first"""
+        records = self.records[rows]
+        if policy == 'lowest_quality':
+            quality = np.nan_to_num(records['quality'].astype(np.float64), nan=-np.inf)
+            order = np.lexsort((records['registered_at'], quality))
+        else:
+            order = np.argsort(records['registered_at'], kind='stable')
+        return [rows[i] for i in order]
+
+    def add_many(self, items, max_templates=None, policy='oldest', replace=False, sync=False):
+        """Append (user_id, encoding, registered_at, quality) rows in one write
+
+        Each row is one template of the user. With `replace` the user's existing
+        templates are tombstoned; otherwise, once a user would exceed
+        `max_templates`, the oldest or lowest-quality templates are evicted.
+        With `sync` the files are fsynced once before the write is published:
+        encodings first, then the records that commit them, so a crash never
+        leaves a record pointing at a missing encoding. Replaced templates are
+        only tombstoned after the new rows are durable, so a crash in between
+        leaves an extra template rather than a user with none.
+        """
+        items, vectors, records = self._pack(items, max_templates)
+        if not items:
+            return
+
+        with self.lock, self.file_lock():
+            self._catch_up()
+            victims = self._victims(items, max_templates, policy, replace)
+
+            # Other workers may have appended since we last mapped the files
+            start = self._committed_rows()
+            with open(self.vectors_path, 'r+b') as f:
+                f.seek(start * self.row_bytes)
+                f.write(vectors.tobytes())
+                if sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            with open(self.records_path, 'r+b') as f:
+                f.seek(start * GALLERY_RECORD.itemsize)
+                f.write(records.tobytes())
+                if sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+
+            previous_size = self.size
+            self._map(start + len(items))
+            self._apply_rows(previous_size, self.size)
+
+            for user_id, row in victims:
+                self._tombstone(row)
+                self._drop_row(row, user_id)
+            if sync and victims:
+                self._sync_files([self.records_path, self.deletions_path])
+            self._bump_sequence()
+
+    def _pack(self, items, max_templates=None):
+        """Turn (user_id, encoding, registered_at, quality) items into vector and record arrays"""
+        items = list(items)
+        if max_templates:
+            # Never append more new templates per user than can be kept
+            remaining = Counter(str(item[0]) for item in items)
+            trimmed = []
+            for item in items:
+                remaining[str(item[0])] -= 1
+                if remaining[str(item[0])] < max_templates:
+                    trimmed.append(item)
+            items = trimmed
+
+        for item in items:
+            error = user_id_error(item[0])
+            if error:
+                # numpy would silently truncate the id when storing it
+                raise ValueError(error)
+
+        vectors = np.empty((len(items), self.dimensions), dtype=self.dtype)
+        records = np.zeros(len(items), dtype=GALLERY_RECORD)
+        for i, (user_id, encoding, registered_at, quality) in enumerate(items):
+            vectors[i] = encoding
+            records[i]['user_id'] = str(user_id).encode()
+            records[i]['registered_at'] = registered_at or time.time()
+            records[i]['quality'] = np.nan if quality is None else quality
+        records['norm'] = np.einsum('ij,ij->i', vectors, vectors)
+        return items, vectors, records
+
+    def _victims(self, items, max_templates=None, policy='oldest', replace=False):
+        """(user_id, row) pairs that make room for the new items; caller holds the locks"""
+        victims = []
+        for user_id, count in Counter(str(item[0]) for item in items).items():
+            existing = list(self.rows.get(user_id, ()))
+            if replace:
+                rows = existing
+            elif max_templates and len(existing) + count > max_templates:
+                rows = self._eviction_order(existing, policy)[:len(existing) + count - max_templates]
+            else:
+                rows = []
+            victims.extend((user_id, row) for row in rows)
+        return victims
+
+    def add(self, user_id, encoding, registered_at=None, quality=None, max_templates=None, policy='oldest'):
+        """Store one more template for a user, evicting per `policy` when full"""
+        self.add_many([(user_id, encoding, registered_at, quality)], max_templates, policy)
+
+    def remove(self, user_id, sync=False):
+        """Tombstone every template of a user"""
+        user_id = str(user_id)
+        with self.lock, self.file_lock():
+            self._catch_up()
+            rows = list(self.rows.get(user_id, ()))
+            if not rows:
+                return False
+
+            for row in rows:
+                self._tombstone(row)
+                self._drop_row(row, user_id)
+            if sync:
+                self._sync_files([self.records_path, self.deletions_path])
+            self._bump_sequence()
+            return True
+
+    def _switch_generation(self, rows, vectors=None, records=None):
+        """Write `rows` (plus new vectors/records) as the next generation and commit it; caller holds the locks"""
+        old_paths = (self.vectors_path, self.records_path, self.deletions_path)
+        self.generation += 1
+        for path, source, extra in ((self.vectors_path, self.matrix, vectors), (self.records_path, self.records, records)):
+            with open(path, 'wb') as f:
+                for start in range(0, len(rows), 65536):
+                    f.write(np.ascontiguousarray(source[rows[start:start + 65536]]).tobytes())
+                if extra is not None:
+                    f.write(extra.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+
+        # Switching the header is the commit point; old files are garbage after it
+        self._write_header()
+        for path in old_paths:
+            os.remove(path)
+
+        self._open_files()
+        self._bump_sequence()
+
+    def compact(self):
+        """Rewrite live rows into a new generation, dropping tombstoned ones"""
+        with self.lock, self.file_lock():
+            self._catch_up()
+            self._map(self._committed_rows())
+            live = np.flatnonzero(self.records['deleted'] == 0)
+            removed = self.size - len(live)
+            if not removed:
+                return 0
+
+            self._switch_generation(live)
+            logger.info(f"Compacted gallery: dropped {removed} tombstoned rows, {self.size} remain")
+            return removed
+
+    def bulk_add(self, items, max_templates=None, policy='oldest', replace=False):
+        """Add many rows in one atomic commit, for offline enrollment
+
+        The live rows that survive eviction and the new rows are written to a
+        new generation, fsynced, and committed by the header switch, so after a
+        crash either all of the items are in the gallery or none are. This
+        rewrites the whole gallery (dropping tombstones on the way); per-request
+        writes should use `add_many`. Returns the number of rows added.
+        """
+        items, vectors, records = self._pack(items, max_templates)
+        if not items:
+            return 0
+
+        with self.lock, self.file_lock():
+            self._catch_up()
+            self._map(self._committed_rows())
+            dropped = [row for _, row in self._victims(items, max_templates, policy, replace)]
+            live = np.flatnonzero(self.records['deleted'] == 0)
+            self._switch_generation(live[~np.isin(live, dropped)], vectors, records)
+
+            logger.info(f"Bulk added {len(items)} rows, replaced {len(dropped)}; gallery holds {len(self.rows)} users")
+            return len(items)
+
+    def templates(self, user_id):
+        """Return a (templates, 128) copy of a user's encodings, or None"""
+        with self.lock:
+            rows = self.rows.get(str(user_id))
+            return None if not rows else np.array(self.matrix[sorted(rows)])
+
+    def verify(self, user_id, encoding, aggregation='min'):
+        """Distance from an encoding to one user's templates, or None if the user is unknown
+
+        Only that user's rows are read, so the cost does not grow with the gallery.
+        """
+        templates = self.templates(user_id)
+        if templates is None:
+            return None
+
+        query = np.asarray(encoding, dtype=self.dtype)
+        if aggregation == 'centroid':
+            return float(np.linalg.norm(templates.mean(axis=0) - query))
+        return float(np.linalg.norm(templates - query, axis=1).min())
+
+    def user_summary(self, user_id):
+        """Return (template count, latest registered_at, best quality) from memory, or None"""
+        with self.lock:
+            rows = self.rows.get(str(user_id))
+            if not rows:
+                return None
+            registered_at, quality = self.user_meta[str(user_id)]
+            return len(rows), registered_at, quality
+
+    def user_records(self, user_id):
+        """Return a copy of the metadata records of a user's templates, or None"""
+        with self.lock:
+            rows = self.rows.get(str(user_id))
+            return None if not rows else np.array(self.records[sorted(rows)])
+
+    def import_legacy_files(self, data_dir, batch_size=1000, skip_existing=False):
+        """Import per-user `<user_id>.npy` + `_meta.json` files into the gallery"""
+        batch = []
+        imported = 0
+
+        for filename in sorted(os.listdir(data_dir)):
+            if not filename.endswith('.npy'):
+                continue
+
+            user_id = filename[:-len('.npy')]
+            if skip_existing and user_id in self:
+                continue
+            try:
+                encoding = np.load(os.path.join(data_dir, filename))
+                registered_at = None
+                metadata_path = os.path.join(data_dir, f"{user_id}_meta.json")
+                if os.path.exists(metadata_path):
+                    with open(metadata_path, 'r') as f:
+                        registered_at = datetime.fromisoformat(json.load(f)['registered_at']).timestamp()
+                batch.append((user_id, encoding, registered_at, None))
+            except Exception as e:
+                logger.error(f"Error importing legacy encoding for user {user_id}: {e}")
+
+            if len(batch) >= batch_size:
+                self.add_many(batch, replace=True)
+                imported += len(batch)
+                batch = []
+
+        self.add_many(batch, replace=True)
+        imported += len(batch)
+        return imported
+
+    def index_needs_training(self):
+        count = self.template_count
+        return count >= self.index_min_size and self.index.needs_training(count)
+
+    def build_index(self, path=None):
+        """(Re)train the ANN index over the live rows and optionally persist it
+
+        k-means runs on a snapshot outside the lock so searches keep being
+        served; only the final row assignment blocks writers.
+        """
+        with self.lock:
+            if not self.index_needs_training():
+                return False
+            snapshot = np.array(self.matrix[self.live_rows()])
+
+        centroids = self.index.fit(snapshot)
+
+        with self.lock:
+            self.index.use_centroids(centroids, self.matrix, self.live_rows())
+            if path:
+                with self.file_lock():
+                    # Catch up first: bumping the counter marks everything before it as seen
+                    self._catch_up()
+                    self.index.save(path)
+                    self.index_path = path
+                    self.index_stamp = self._index_file_stamp()
+                    # Tell the other workers to reload the saved index
+                    self._bump_sequence()
+            logger.info(f"Built {self.index.name} index over {self.template_count} encodings")
+            return True
+
+    def load_index(self, path):
+        """Restore a persisted index, training a fresh one if none is usable
+
+        Other workers' later saves of `path` are picked up by `refresh`.
+        """
+        with self.lock:
+            self.index_path = path
+            self.index_stamp = self._index_file_stamp()
+            try:
+                if self.index.load(path, self.matrix, self.live_rows()):
+                    logger.info(f"Loaded {self.index.name} index from {path}")
+                    return True
+            except Exception as e:
+                logger.error(f"Error loading gallery index: {e}")
+        return self.build_index(path)
+
+    def _centroid_norms(self):
+        """Squared norms of each user's template centroid, recomputing stale slots"""
+        stale = np.flatnonzero(np.isnan(self.slot_norms[:len(self.slot_users)]))
+        for slot in stale.tolist():
+            rows = self.rows.get(self.slot_users[slot])
+            if rows:
+                centroid = np.asarray(self.matrix[rows], dtype=np.float64).mean(axis=0)
+                self.slot_norms[slot] = np.dot(centroid, centroid)
+            else:
+                self.slot_norms[slot] = 0.0
+        return self.slot_norms
+
+    def _grouping(self, row_slots):
+        """Group live rows by user slot as (row order, reduceat boundaries, slots)"""
+        order = np.flatnonzero(row_slots >= 0)
+        order = order[np.argsort(row_slots[order], kind='stable')]
+        sorted_slots = row_slots[order]
+        boundaries = np.flatnonzero(np.r_[True, sorted_slots[1:] != sorted_slots[:-1]])
+        return order, boundaries, sorted_slots[boundaries]
+
+    def _quantized_candidates(self, queries, top_k):
+        """First pass on the packed copy: (generation, rows) worth re-ranking, or None
+
+        Returns None when an exact scan is cheap enough or the ANN index will
+        be used instead.
+        """
+        with self.lock:
+            rerank = max(self.quantizer.rerank, top_k)
+            if len(self.rows) <= rerank or (len(self.rows) >= self.index_min_size and self.index.ready):
+                return None
+            generation, size, norms = self.generation, self.size, self.norms
+            live = self.row_slots[:size] >= 0
+
+        # ||q||^2 is the same for every row of a column, so it does not change the order
+        squared = norms[:size, None] - 2 * self.quantizer.dots(size, queries)
+        squared[~live] = np.inf
+        count = min(rerank, int(np.count_nonzero(live)))
+        nearest = np.argpartition(squared, count - 1, axis=0)[:count]
+        return generation, np.unique(nearest)
+
+    def _user_rows(self, rows):
+        """Every live row of the users owning `rows`; caller holds the lock"""
+        rows = rows[rows < self.size]
+        slots = np.unique(self.row_slots[rows])
+        owned = [self.rows.get(self.slot_users[slot]) for slot in slots[slots >= 0].tolist()]
+        owned = [user_rows for user_rows in owned if user_rows]
+        return np.sort(np.concatenate(owned)).astype(np.int64) if owned else np.zeros(0, dtype=np.int64)
+
+    def search(self, encoding, top_k=1, exact=False, aggregation='min'):
+        """Return the `top_k` closest (user_id, distance) pairs, nearest first"""
+        return self.search_many([encoding], top_k, exact, aggregation)[0]
+
+    def search_many(self, encodings, top_k=1, exact=False, aggregation='min'):
+        """Match several encodings at once, returning one result list per encoding
+
+        Every template is scored in a single matrix product and distances are
+        aggregated per user: `min` keeps the closest template, `centroid`
+        measures the distance to the mean of the user's templates. Uses the
+        ANN index when it is trained and the gallery is large enough, falling
+        back to an exact scan otherwise or when `exact` is set. With a
+        quantizer, that scan runs on the packed copy and only the users owning
+        its nearest rows are scored exactly.
+        """
+        queries = np.atleast_2d(np.asarray(encodings, dtype=self.dtype))
+        if not len(queries):
+            return []
+
+        quantized = self._quantized_candidates(queries, top_k) if self.quantizer and not exact else None
+
+        # Only grab references under the lock; remapping replaces these arrays
+        # rather than mutating them, so the distance maths can run unlocked
+        with self.lock:
+            if not self.rows:
+                return [[] for _ in queries]
+
+            matrix, norms, records, slot_users = self.matrix, self.norms, self.records, self.slot_users
+            slot_norms = self._centroid_norms() if aggregation == 'centroid' else None
+            rows = None
+            if quantized and quantized[0] == self.generation:
+                rows = self._user_rows(quantized[1])
+            elif not exact and len(self.rows) >= self.index_min_size:
+                candidates = [self.index.candidates(query) for query in queries]
+                if all(c is not None and len(c) >= top_k for c in candidates):
+                    rows = np.unique(np.concatenate(candidates))
+                    if aggregation == 'centroid':
+                        # Probed lists may hold only some of a user's templates;
+                        # the centroid needs all of them
+                        rows = self._user_rows(rows)
+
+            if rows is None:
+                if self.full_grouping is None:
+                    self.full_grouping = self._grouping(self.row_slots[:self.size])
+                order, boundaries, present = self.full_grouping
+            else:
+                order, boundaries, present = self._grouping(self.row_slots[rows])
+                order = rows[order]
+
+        if not len(order):
+            return [[] for _ in queries]
+
+        # ||a - b||^2 = ||a||^2 + ||b||^2 - 2ab, one matrix product for all queries
+        if rows is None:
+            dots = (matrix @ queries.T)[order]
+        else:
+            dots = matrix[order] @ queries.T
+        query_norms = np.einsum('ij,ij->i', queries, queries)
+
+        if aggregation == 'centroid':
+            # centroid . q is the mean of the template dot products
+            counts = np.diff(np.r_[boundaries, len(order)])
+            sums = np.add.reduceat(dots, boundaries, axis=0)
+            squared = query_norms[None, :] - 2 * sums / counts[:, None] + slot_norms[present][:, None]
+        else:
+            row_squared = norms[order][:, None] + query_norms[None, :] - 2 * dots
+            # Tombstones are read from the shared mapping, so deletes made by
+            # other workers are honoured before their journal is applied
+            row_squared[records['deleted'][order] != 0] = np.inf
+            squared = np.minimum.reduceat(row_squared, boundaries, axis=0)
+        distances = np.sqrt(np.maximum(squared, 0))
+
+        top_k = max(1, min(top_k, len(present)))
+        results = []
+        for column in distances.T:
+            if top_k < len(column):
+                nearest = np.argpartition(column, top_k - 1)[:top_k]
+                nearest = nearest[np.argsort(column[nearest])]
+            else:
+                nearest = np.argsort(column)
+            results.append([
+                (slot_users[present[i]], float(column[i]))
+                for i in nearest if np.isfinite(column[i])
+            ])
+        return results
+
+MATCH_RECORD = np.dtype([
+    ('user_id', 'S32'),
+    ('matched_at', '<f8'),
+])
+
+class MatchLog:
+    """Time of each user's last match, shared by every worker through an mmap'd side file
+
+    `last_match.bin` next to the gallery is a fixed-size open-addressing table
+    of MATCH_RECORD slots; a user lives in one of the `probes` slots after
+    crc32(user_id). Writers take an flock on the file, readers scan the map
+    without locking. When all probe slots are taken the oldest entry in them
+    is overwritten, so the file never grows and an evicted user only loses
+    its last_match_at. The file is sparse, so untouched slots cost no disk.
+    """
+
+    def __init__(self, data_dir, slots=1 << 20, probes=32):
+        self.path = os.path.join(data_dir, 'last_match.bin')
+        if not os.path.exists(self.path):
+            with open(self.path, 'ab') as f:
+                f.truncate(slots * MATCH_RECORD.itemsize)
+        self.slots = os.path.getsize(self.path) // MATCH_RECORD.itemsize
+        self.probes = min(probes, self.slots)
+        self.table = np.memmap(self.path, dtype=MATCH_RECORD, mode='r+', shape=(self.slots,))
+
+    def _window(self, key):
+        start = zlib.crc32(key) % self.slots
+        return (start + np.arange(self.probes)) % self.slots
+
+    @contextmanager
+    def _locked(self):
+        # A fresh handle per write, so threads and forked workers exclude each other
+        with open(self.path, 'rb') as handle:
+            if fcntl:
+                fcntl.flock(handle, fcntl.LOCK_EX)
+            yield
+
+    def get(self, user_id):
+        """Epoch seconds of the user's last match, or None"""
+        key = str(user_id).encode()
+        window = self._window(key)
+        hits = window[self.table['user_id'][window] == key]
+        if not len(hits):
+            return None
+        matched_at = float(self.table['matched_at'][hits[0]])
+        return matched_at or None
+
+    def record(self, user_ids, matched_at=None):
+        """Store `matched_at` (default: now) as the last match of every user"""
+        matched_at = matched_at or time.time()
+        with self._locked():
+            for user_id in user_ids:
+                key = str(user_id).encode()
+                window = self._window(key)
+                keys = self.table['user_id'][window]
+                hits = np.flatnonzero(keys == key)
+                if not len(hits):
+                    hits = np.flatnonzero(keys == b'')
+                slot = window[hits[0]] if len(hits) else window[np.argmin(self.table['matched_at'][window])]
+                self.table[slot] = (key, matched_at)
+
+    def forget(self, user_id):
+        """Clear a deleted user's last match"""
+        key = str(user_id).encode()
+        with self._locked():
+            window = self._window(key)
+            self.table['matched_at'][window[self.table['user_id'][window] == key]] = 0
+
+class HOGDetector:
+    """dlib HOG + linear SVM detector: fast on CPU, frontal faces only"""
+
+    name = 'hog'
+
+    def __init__(self, upsample=1):
+        self.upsample = upsample
+
+    def locate(self, image_array):
+        return load_face_recognition().face_locations(
+            image_array, number_of_times_to_upsample=self.upsample, model=self.name
+        )
+
+class CNNDetector(HOGDetector):
+    """dlib MMOD CNN detector: handles pose and small faces, needs a GPU to be fast"""
+
+    name = 'cnn'
+
+class CascadeDetector:
+    """OpenCV Haar cascade: cheapest detector, more false positives than HOG"""
+
+    name = 'cascade'
+
+    def __init__(self, upsample=1, scale_factor=1.1, min_neighbors=5):
+        if cv2 is None:
+            raise RuntimeError("The cascade detector requires opencv-python")
+        self.upsample = upsample
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.classifier = cv2.CascadeClassifier(
+            os.path.join(cv2.data.haarcascades, 'haarcascade_frontalface_default.xml')
+        )
+
+    def locate(self, image_array):
+        gray = cv2.cvtColor(image_array, cv2.COLOR_RGB2GRAY)
+        # Each upsample step halves the smallest face found, like dlib's upsampling
+        min_size = max(20, 80 >> self.upsample)
+        faces = self.classifier.detectMultiScale(
+            gray, scaleFactor=self.scale_factor, minNeighbors=self.min_neighbors,
+            minSize=(min_size, min_size)
+        )
+        return [(int(y), int(x + w), int(y + h), int(x)) for x, y, w, h in faces]
+
+def create_detector(kind, upsample=1):
+    """Build the face detector selected by *_DETECTOR"""
+    if kind == 'cnn':
+        return CNNDetector(upsample)
+    if kind == 'cascade' and cv2 is not None:
+        return CascadeDetector(upsample)
+    if kind == 'cascade':
+        logger.warning("opencv-python is not installed, falling back to the hog detector")
+    elif kind != 'hog':
+        logger.warning(f"Unknown face detector '{kind}', falling back to hog")
+    return HOGDetector(upsample)
+
+class DetectionProfile:
+    """Detector, encoding jitters and quality gate used for one kind of request
+
+    Faces scoring below `min_quality` are rejected before they are encoded.
+    """
+
+    def __init__(self, name, detector, jitters=1, min_quality=0.0):
+        self.name = name
+        self.detector = detector
+        self.jitters = jitters
+        self.min_quality = min_quality
+
+    def describe(self):
+        return {
+            'detector': self.detector.name,
+            'upsample': self.detector.upsample,
+            'jitters': self.jitters,
+            'min_quality': self.min_quality
+        }
+
+# Reason codes of the quality gate and the message sent back to the kiosk
+QUALITY_MESSAGES = {
+    'face_too_small': "Face too small: please move closer to the camera",
+    'too_dark': "Image too dark: please improve the lighting",
+    'too_bright': "Image overexposed: please avoid direct light",
+    'low_contrast': "Image contrast too low: please improve the lighting",
+    'blurry': "Image is blurry: please hold still and retake",
+    'face_turned': "Face turned away: please look straight at the camera",
+    'face_tilted': "Head tilted: please keep your head upright",
+}
+QUALITY_REASONS = {message: reason for reason, message in QUALITY_MESSAGES.items()}
+
+def rejection_reason(message):
+    """Quality reason code behind an error message, or None"""
+    return QUALITY_REASONS.get(message)
+
+class InferenceError(Exception):
+    """Inference could not run; `status_code` is the HTTP status to answer with"""
+
+    status_code = 503
+
+class InferenceBusyError(InferenceError):
+    status_code = 503
+
+class InferenceTimeoutError(InferenceError):
+    status_code = 504
+
+class InferenceExecutor:
+    """Process pool for the CPU-bound dlib calls, with a bounded queue
+
+    At most `workers + queue_size` jobs are admitted at once; further jobs are
+    rejected immediately with InferenceBusyError instead of queueing behind a
+    burst. A job that exceeds `timeout` seconds raises InferenceTimeoutError
+    (it keeps its slot until the worker process actually finishes it).
+    """
+
+    def __init__(self, workers=4, queue_size=8, timeout=30):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(workers + queue_size)
+        self.lock = threading.Lock()
+        self.pool = None
+        self.pool_pid = None
+        self.in_flight = 0
+
+    def get_pool(self):
+        """Start the pool on first use, and again after a fork or a crashed worker"""
+        with self.lock:
+            if self.pool is None or self.pool_pid != os.getpid():
+                self.pool = ProcessPoolExecutor(max_workers=self.workers)
+                self.pool_pid = os.getpid()
+            return self.pool
+
+    def _release(self, future=None):
+        with self.lock:
+            self.in_flight -= 1
+        self.slots.release()
+
+    def _admit(self, wait=0):
+        """Take an admission slot, waiting up to `wait` seconds (None: until one frees up)"""
+        if not self.slots.acquire(blocking=wait != 0, timeout=wait or None):
+            raise InferenceBusyError("Server busy, please retry shortly")
+        with self.lock:
+            self.in_flight += 1
+
+    @contextmanager
+    def admit(self, wait=0):
+        """Hold a slot while dlib runs in the calling thread instead of the pool"""
+        self._admit(wait)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def run(self, fn, *args, wait=0):
+        """Run fn(*args) in a worker process and wait for its result"""
+        self._admit(wait)
+        
+        try:
+            future = self.get_pool().submit(fn, *args)
+        except BrokenProcessPool:
+            self._release()
+            with self.lock:
+                self.pool = None
+            raise InferenceBusyError("Inference workers restarting, please retry")
+        except Exception:
+            self._release()
+            raise
+        future.add_done_callback(self._release)
+        
+        try:
+            return future.result(timeout=self.timeout)
+        except FuturesTimeoutError:
+            future.cancel()
+            raise InferenceTimeoutError(f"Face processing timed out after {self.timeout:g}s")
+        except BrokenProcessPool:
+            with self.lock:
+                self.pool = None
+            raise InferenceBusyError("Inference worker crashed, please retry")
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'queue_size': self.queue_size,
+            'in_flight': self.in_flight,
+            'timeout': self.timeout
+        }
+
+def public_user_id(user_id):
+    """Stored ids are strings; numeric ones are answered as ints, like the ids clients register"""
+    try:
+        return int(user_id)
+    except (TypeError, ValueError):
+        return user_id
+
+def shard_for(user_id, shard_count):
+    """Shard owning a user id; crc32 rather than hash() so every process agrees"""
+    return zlib.crc32(str(user_id).encode()) % shard_count
+
+class ShardUnavailableError(InferenceError):
+    status_code = 503
+
+class ShardRouter:
+    """Scatter-gather client used by a coordinator in front of the shards
+
+    `urls[i]` is the face-server holding the users with shard_for(user_id) == i.
+    Encodings are computed once on the coordinator and sent to every shard's
+    /match in parallel; the per-shard top-k lists are merged by distance.
+    Users live on exactly one shard, so merging per-user distances is exact.
+    A shard that errors or misses `timeout` is left out and reported, and the
+    match only fails when no shard answered.
+    """
+
+    def __init__(self, urls, timeout=2.0, threads_per_shard=4):
+        self.urls = [url.rstrip('/') for url in urls]
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=len(self.urls) * threads_per_shard,
+                                           thread_name_prefix='shard')
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.searches = 0
+        self.partial = 0
+        self.failures = Counter()
+
+    def __len__(self):
+        return len(self.urls)
+
+    def owner(self, user_id):
+        return shard_for(user_id, len(self.urls))
+
+    def _post(self, shard, path, payload):
+        response = requests.post(f"{self.urls[shard]}{path}", json=payload, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()
+
+    def scatter(self, payloads, path):
+        """POST payloads[shard] to each shard in parallel; returns ({shard: json}, {shard: error})"""
+        futures = {
+            self.executor.submit(self._post, shard, path, payload): shard
+            for shard, payload in payloads.items()
+        }
+        done, late = wait(futures, timeout=self.timeout)
+        answers, failed = {}, {}
+        for future in late:
+            future.cancel()
+            failed[futures[future]] = 'timeout'
+        for future in done:
+            try:
+                answers[futures[future]] = future.result()
+            except Exception as e:
+                failed[futures[future]] = 'timeout' if isinstance(e, requests.Timeout) else str(e)
+
+        with self.lock:
+            for shard, error in failed.items():
+                self.failures[self.urls[shard]] += 1
+        for shard, error in failed.items():
+            logger.warning(f"Shard {shard} ({self.urls[shard]}) failed: {error}")
+        return answers, failed
+
+    def search_many(self, encodings, top_k=1, exact=False):
+        """Match encodings on every shard and merge their candidates by distance"""
+        payload = {'encodings': np.asarray(encodings, dtype=np.float64).tolist(), 'top_k': top_k, 'exact': exact}
+        answers, failed = self.scatter({shard: payload for shard in range(len(self.urls))}, '/match')
+
+        self.local.report = {
+            'queried': len(self.urls),
+            'answered': len(answers),
+            'failed': {str(shard): error for shard, error in sorted(failed.items())}
+        }
+        with self.lock:
+            self.searches += 1
+            self.partial += bool(failed)
+        if not answers:
+            raise ShardUnavailableError("No shard answered, please retry shortly")
+
+        merged = [[] for _ in encodings]
+        for answer in answers.values():
+            for candidates, matches in zip(merged, answer['matches']):
+                candidates.extend((match['user_id'], match['distance']) for match in matches)
+        return [sorted(candidates, key=lambda match: match[1])[:top_k] for candidates in merged]
+
+    def report(self):
+        """Shard outcome of the last search made by this thread"""
+        return getattr(self.local, 'report', None)
+
+    def forward(self, user_id, method, path, **kwargs):
+        """Send a per-user request to the shard owning the user; returns the requests response"""
+        shard = self.owner(user_id)
+        try:
+            return requests.request(method, f"{self.urls[shard]}{path}", timeout=self.timeout, **kwargs)
+        except requests.RequestException as e:
+            with self.lock:
+                self.failures[self.urls[shard]] += 1
+            raise ShardUnavailableError(f"Shard {shard} unavailable: {e}")
+
+    def stats(self):
+        with self.lock:
+            return {
+                'shards': self.urls,
+                'timeout': self.timeout,
+                'searches': self.searches,
+                'partial_searches': self.partial,
+                'failures': dict(self.failures)
+            }
+
+def run_inference_job(image_data, profile_name):
+    """Inference worker entry point: decode, detect and encode with the named profile"""
+    timings = {}
+    profile = face_service.enroll_profile if profile_name == 'enroll' else face_service.recognize_profile
+    return face_service.process_image(image_data, timings, profile) + (timings,)
+
+def run_group_inference_job(image_data):
+    """Inference worker entry point for group frames: every face with the recognition profile"""
+    timings = {}
+    return face_service.process_group_image(image_data, timings) + (timings,)
+
+class MemoryCacheBackend:
+    """Dict-backed stand-in for the shared cache (development and single-host setups)
+
+    Bounded like the local cache: expired entries are dropped when read and
+    the least recently used ones once `max_entries` is exceeded.
+    """
+
+    name = 'memory'
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value, expires = self.entries.get(key, (None, 0))
+            if expires > time.time():
+                self.entries.move_to_end(key)
+                return value
+            self.entries.pop(key, None)
+            return None
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (value, time.time() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+class RedisCacheBackend:
+    """Embedding cache shared by every worker and host through Redis"""
+
+    name = 'redis'
+
+    def __init__(self, url, prefix='face:embedding:'):
+        import redis
+        self.client = redis.Redis.from_url(url, socket_timeout=0.5)
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix + key)
+
+    def set(self, key, value, ttl):
+        self.client.setex(self.prefix + key, ttl, value)
+
+def create_cache_backend(url, max_entries=1024):
+    """Shared cache backend for REDIS_URL: redis://... or memory://, None when unset"""
+    if not url:
+        return None
+    if url.startswith('memory://'):
+        return MemoryCacheBackend(max_entries)
+    try:
+        return RedisCacheBackend(url)
+    except ImportError:
+        logger.warning("REDIS_URL is set but the redis package is not installed, using the local cache only")
+        return None
+
+class EmbeddingCache:
+    """LRU + TTL cache of face analysis results keyed by a hash of the raw image bytes
+
+    Retried kiosk frames and re-sent photos skip decoding, detection and
+    encoding. Entries live in a bounded in-process LRU; an optional shared
+    backend lets workers reuse each other's results. Backend failures only
+    count as misses.
+    """
+
+    def __init__(self, max_entries=1024, ttl=3600, backend=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.backend = backend
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.errors = 0
+
+    @staticmethod
+    def key(image_data, profile):
+        """Content hash of the image plus everything that changes the encoding"""
+        digest = hashlib.blake2b(image_data, digest_size=16).hexdigest()
+        settings = profile.describe()
+        return (
+            f"{profile.name}:{settings['detector']}:{settings['upsample']}:{settings['jitters']}:"
+            f"{settings['min_quality']}:{digest}"
+        )
+
+    @staticmethod
+    def pack(value):
+        encoding, location, quality = value
+        return json.dumps({
+            'encoding': np.asarray(encoding, dtype=np.float64).tolist(),
+            'location': [int(v) for v in location],
+            'quality': quality
+        })
+
+    @staticmethod
+    def unpack(raw):
+        data = json.loads(raw)
+        return np.array(data['encoding']), tuple(data['location']), data['quality']
+
+    def get(self, key):
+        """Return (encoding, location, quality) or None"""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            if entry is not None:
+                del self.entries[key]
+        
+        if self.backend is not None:
+            try:
+                raw = self.backend.get(key)
+                if raw is not None:
+                    value = self.unpack(raw)
+                    self._store(key, value)
+                    with self.lock:
+                        self.shared_hits += 1
+                    return value
+            except Exception as e:
+                logger.warning(f"Embedding cache backend read failed: {e}")
+                with self.lock:
+                    self.errors += 1
+        
+        with self.lock:
+            self.misses += 1
+        return None
+
+    def _store(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.time() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def put(self, key, value):
+        self._store(key, value)
+        if self.backend is not None:
+            try:
+                self.backend.set(key, self.pack(value), self.ttl)
+            except Exception as e:
+                logger.warning(f"Embedding cache backend write failed: {e}")
+                with self.lock:
+                    self.errors += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl,
+                'backend': self.backend.name if self.backend else None,
+                'hits': self.hits,
+                'shared_hits': self.shared_hits,
+                'misses': self.misses,
+                'errors': self.errors,
+                'hit_rate': round((self.hits + self.shared_hits) / lookups, 4) if lookups else 0.0
+            }
+
+class GroupCommitter:
+    """Coalesce concurrent gallery appends into shared, fsynced writes
+
+    Callers queue their rows and block. The first caller that finds no commit
+    in flight becomes the leader: it waits up to `window` seconds for more rows,
+    then writes everything queued so far with one add_many call per run of the
+    same replace mode, and so one fsync for the whole group. Followers return
+    once the commit that carried their rows is on disk.
+    """
+
+    def __init__(self, gallery, max_templates=None, policy='oldest', sync=True, window=0.0):
+        self.gallery = gallery
+        self.max_templates = max_templates
+        self.policy = policy
+        self.sync = sync
+        self.window = window
+        self.condition = threading.Condition()
+        self.queued = []
+        self.committing = False
+        self.next_ticket = 0
+        # Every ticket below this one has been written
+        self.done_ticket = 0
+        self.errors = {}
+        self.commits = 0
+        self.entries = 0
+
+    def commit(self, items, replace=False):
+        """Append (user_id, encoding, registered_at, quality) rows, sharing the write with concurrent callers"""
+        with self.condition:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+            self.queued.append((ticket, list(items), bool(replace)))
+            while self.committing and self.done_ticket <= ticket:
+                self.condition.wait()
+            lead = self.done_ticket <= ticket
+            if lead:
+                self.committing = True
+
+        if lead:
+            self._lead()
+
+        with self.condition:
+            error = self.errors.pop(ticket, None)
+        if error:
+            raise error
+
+    def _lead(self):
+        if self.window:
+            time.sleep(self.window)
+        with self.condition:
+            group, self.queued = self.queued, []
+
+        error = None
+        try:
+            self._write(group)
+        except Exception as e:
+            error = e
+
+        with self.condition:
+            for ticket, _, _ in group:
+                if error:
+                    self.errors[ticket] = error
+            self.commits += 1
+            self.entries += sum(len(items) for _, items, _ in group)
+            self.done_ticket = group[-1][0] + 1
+            self.committing = False
+            self.condition.notify_all()
+
+    def _write(self, group):
+        # Keep arrival order: a replace only covers rows queued before it
+        runs = []
+        for _, items, replace in group:
+            users = {str(item[0]) for item in items}
+            if not runs or runs[-1][0] != replace or (replace and users & runs[-1][2]):
+                runs.append((replace, [], set()))
+            runs[-1][1].extend(items)
+            runs[-1][2].update(users)
+
+        for replace, items, _ in runs:
+            self.gallery.add_many(
+                items, max_templates=self.max_templates, policy=self.policy,
+                replace=replace, sync=self.sync
+            )
+
+    def stats(self):
+        return {
+            'sync': self.sync,
+            'window_ms': self.window * 1000,
+            'commits': self.commits,
+            'entries': self.entries,
+            'entries_per_commit': round(self.entries / self.commits, 2) if self.commits else 0.0
+        }
+
+class EnrollmentQueue:
+    """Background enrollment jobs with bounded concurrency
+
+    Each job is a list of (user_id, image bytes, replace) entries processed in
+    batches of `batch_size`: every batch is analyzed, then appended to the
+    gallery with one add_many call and a single fsync. Job state lives in
+    `<jobs_dir>/<job_id>.json`, rewritten atomically after every batch, so any
+    gunicorn worker can answer status polls. Photos stay in the memory of the
+    worker that accepted the job.
+    """
+
+    def __init__(self, service, jobs_dir, workers=1, max_jobs=16, batch_size=32, ttl=86400):
+        self.service = service
+        self.jobs_dir = jobs_dir
+        self.workers = workers
+        self.batch_size = batch_size
+        self.ttl = ttl
+        self.pending = queue.Queue(maxsize=max_jobs)
+        self.threads = []
+        self.threads_pid = None
+        self.lock = threading.Lock()
+
+    def job_path(self, job_id):
+        return os.path.join(self.jobs_dir, f"{job_id}.json")
+
+    def _write(self, job):
+        job['updated_at'] = datetime.now().isoformat()
+        tmp_path = f"{self.job_path(job['job_id'])}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(job, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.job_path(job['job_id']))
+        fsync_directory(self.jobs_dir)
+
+    def _start_workers(self):
+        """Start the worker threads on first use, and again in a forked child"""
+        with self.lock:
+            if self.threads_pid == os.getpid():
+                return
+            self.threads = [
+                threading.Thread(target=self._run, name=f'enroll-{i}', daemon=True)
+                for i in range(self.workers)
+            ]
+            for thread in self.threads:
+                thread.start()
+            self.threads_pid = os.getpid()
+
+    def _expire_jobs(self):
+        cutoff = time.time() - self.ttl
+        for name in os.listdir(self.jobs_dir):
+            path = os.path.join(self.jobs_dir, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+            except OSError:
+                pass
+
+    def submit(self, entries):
+        """Queue a job of (user_id, image_data, replace) entries; None when the queue is full"""
+        os.makedirs(self.jobs_dir, exist_ok=True)
+        self._expire_jobs()
+        self._start_workers()
+        
+        now = datetime.now().isoformat()
+        job = {
+            'job_id': uuid.uuid4().hex,
+            'status': 'queued',
+            'total': len(entries),
+            'processed': 0,
+            'succeeded': 0,
+            'failed': 0,
+            'created_at': now,
+            'updated_at': now,
+            'users': [
+                {'index': i, 'user_id': user_id, 'status': 'pending', 'message': None, 'quality': None}
+                for i, (user_id, _, _) in enumerate(entries)
+            ]
+        }
+        
+        if self.pending.full():
+            return None
+        # Written before queueing: from here on only the worker touches the job
+        self._write(job)
+        summary = {key: job[key] for key in ('job_id', 'status', 'total')}
+        try:
+            self.pending.put_nowait((job, list(entries)))
+        except queue.Full:
+            os.remove(self.job_path(job['job_id']))
+            return None
+        return summary
+
+    def status(self, job_id):
+        """Job state as written by whichever worker owns the job, or None"""
+        if not all(c in '0123456789abcdef' for c in job_id):
+            return None
+        try:
+            with open(self.job_path(job_id), 'r') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _run(self):
+        while True:
+            job, entries = self.pending.get()
+            try:
+                self._process(job, entries)
+            except Exception as e:
+                logger.error(f"Enrollment job {job['job_id']} failed: {traceback.format_exc()}")
+                job['status'] = 'failed'
+                job['error'] = str(e)
+                self._write(job)
+            finally:
+                self.pending.task_done()
+
+    def _process(self, job, entries):
+        service = self.service
+        job['status'] = 'running'
+        self._write(job)
+        
+        for start in range(0, len(entries), self.batch_size):
+            indices = range(start, min(len(entries), start + self.batch_size))
+            batches = {False: [], True: []}
+            for i in indices:
+                user_id, image_data, replace = entries[i]
+                entries[i] = None
+                user = job['users'][i]
+                if not service.owns(user_id):
+                    user.update(status='failed', message=f"User belongs to shard {shard_for(user_id, service.shard_count)}")
+                    continue
+                try:
+                    # Background work queues for a slot instead of being turned away
+                    encoding, _, quality, error = service.analyze_image(
+                        image_data, None, service.enroll_profile, wait=None
+                    )
+                except InferenceError as e:
+                    encoding, quality, error = None, None, str(e)
+                if error:
+                    user.update(status='failed', message=error, reason=rejection_reason(error))
+                    continue
+                batches[bool(replace)].append((user_id, encoding, None, quality))
+                user.update(status='registered', message='Face registered successfully', quality=quality)
+            
+            # One append and one fsync per batch and replace mode
+            for replace, items in batches.items():
+                if items:
+                    service.committer.commit(items, replace)
+            
+            job['processed'] = indices.stop
+            job['succeeded'] = sum(1 for user in job['users'] if user['status'] == 'registered')
+            job['failed'] = sum(1 for user in job['users'] if user['status'] == 'failed')
+            self._write(job)
+        
+        service.schedule_index_build()
+        job['status'] = 'completed'
+        self._write(job)
+        logger.info(f"Enrollment job {job['job_id']}: {job['succeeded']}/{job['total']} faces registered")
+
+@contextmanager
+def timed(timings, stage):
+    """Add the wall time of the block to timings[stage] in milliseconds (no-op when timings is None)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if timings is not None:
+            timings[stage] = round(timings.get(stage, 0.0) + (time.perf_counter() - start) * 1000, 2)
+
+class LatencyHistogram:
+    """Cumulative Prometheus-style buckets plus a rolling window for percentiles"""
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self, window=1024):
+        self.buckets = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, seconds):
+        self.buckets[bisect_left(self.BUCKETS, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        self.recent.append(seconds)
+
+    def quantiles(self, quantiles=(0.5, 0.95, 0.99)):
+        """Percentiles over the most recent observations"""
+        if not self.recent:
+            return {}
+        values = np.percentile(np.fromiter(self.recent, dtype=np.float64), [q * 100 for q in quantiles])
+        return dict(zip(quantiles, values.tolist()))
+
+class MetricsRegistry:
+    """Per-process request and stage latency metrics
+
+    The hot path only appends to a few Python structures under one lock;
+    percentiles and the text exposition are computed when scraped.
+    """
+
+    QUANTILES = (0.5, 0.95, 0.99)
+
+    def __init__(self, window=1024):
+        self.window = window
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.requests = Counter()
+        self.started_at = time.time()
+
+    def record_request(self, endpoint, status, total_seconds, timings_ms=None):
+        """Record a finished request with the per-stage milliseconds it collected"""
+        stages = [('total', total_seconds)]
+        stages.extend((stage, ms / 1000) for stage, ms in (timings_ms or {}).items())
+        with self.lock:
+            self.requests[(endpoint, status)] += 1
+            for stage, seconds in stages:
+                histogram = self.histograms.get((endpoint, stage))
+                if histogram is None:
+                    histogram = self.histograms[(endpoint, stage)] = LatencyHistogram(self.window)
+                histogram.observe(seconds)
+
+    def latency_summary(self):
+        """{endpoint: {stage: {count, p50, p95, p99}}} in milliseconds"""
+        summary = {}
+        with self.lock:
+            for (endpoint, stage), histogram in sorted(self.histograms.items()):
+                entry = {'count': histogram.count}
+                for q, value in histogram.quantiles(self.QUANTILES).items():
+                    entry[f'p{int(q * 100)}'] = round(value * 1000, 2)
+                summary.setdefault(endpoint, {})[stage] = entry
+        return summary
+
+    def render(self, gauges=None):
+        """Prometheus text exposition format (version 0.0.4)"""
+        lines = [
+            '# HELP face_server_requests_total Requests handled by this worker',
+            '# TYPE face_server_requests_total counter'
+        ]
+        with self.lock:
+            for (endpoint, status), count in sorted(self.requests.items()):
+                lines.append(f'face_server_requests_total{{endpoint="{endpoint}",status="{status}"}} {count}')
+            
+            lines.append('# HELP face_server_stage_duration_seconds Latency per endpoint and pipeline stage')
+            lines.append('# TYPE face_server_stage_duration_seconds histogram')
+            for (endpoint, stage), histogram in sorted(self.histograms.items()):
+                labels = f'endpoint="{endpoint}",stage="{stage}"'
+                cumulative = 0
+                for bound, count in zip(LatencyHistogram.BUCKETS + ('+Inf',), histogram.buckets):
+                    cumulative += count
+                    lines.append(f'face_server_stage_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'face_server_stage_duration_seconds_sum{{{labels}}} {histogram.sum:.6f}')
+                lines.append(f'face_server_stage_duration_seconds_count{{{labels}}} {histogram.count}')
+            
+            lines.append(f'# HELP face_server_stage_latency_seconds Percentiles over the last {self.window} observations')
+            lines.append('# TYPE face_server_stage_latency_seconds summary')
+            for (endpoint, stage), histogram in sorted(self.histograms.items()):
+                labels = f'endpoint="{endpoint}",stage="{stage}"'
+                for q, value in histogram.quantiles(self.QUANTILES).items():
+                    lines.append(f'face_server_stage_latency_seconds{{{labels},quantile="{q}"}} {value:.6f}')
+                lines.append(f'face_server_stage_latency_seconds_sum{{{labels}}} {histogram.sum:.6f}')
+                lines.append(f'face_server_stage_latency_seconds_count{{{labels}}} {histogram.count}')
+        
+        for name, (help_text, kind, value) in sorted((gauges or {}).items()):
+            lines.append(f'# HELP face_server_{name} {help_text}')
+            lines.append(f'# TYPE face_server_{name} {kind}')
+            lines.append(f'face_server_{name} {value}')
+        
+        return '\n'.join(lines) + '\n'
+
+class FaceTracker:
+    """Follow the faces of one camera stream across frames
+
+    Boxes detected in a frame are matched to the existing tracks by overlap
+    (IoU). A track is encoded on every frame until it is decided, and after
+    that only when its box moved away from where it was last encoded or every
+    `reencode_interval` frames; all faces needing an encoding in a frame
+    share one face_encodings call and one gallery search. Only frames where
+    a track was encoded count as votes, and one `identified` event is emitted
+    once a user is backed by `min_frames` separate encodings.
+    """
+
+    def __init__(self, service, min_frames=3, detect_interval=1, reencode_interval=10,
+                 track_iou=0.3, reencode_iou=0.7, max_misses=5):
+        self.service = service
+        self.min_frames = max(1, min_frames)
+        self.detect_interval = max(1, detect_interval)
+        self.reencode_interval = max(1, reencode_interval)
+        self.track_iou = track_iou
+        self.reencode_iou = reencode_iou
+        self.max_misses = max_misses
+        self.tracks = []
+        self.next_track = 1
+        self.frames = 0
+        self.face_frames = 0
+        self.encoded = 0
+
+    @staticmethod
+    def iou(a, b):
+        """Intersection over union of two (top, right, bottom, left) boxes"""
+        inter = max(0, min(a[2], b[2]) - max(a[0], b[0])) * max(0, min(a[1], b[1]) - max(a[3], b[3]))
+        union = (a[2] - a[0]) * (a[1] - a[3]) + (b[2] - b[0]) * (b[1] - b[3]) - inter
+        return inter / union if union > 0 else 0.0
+
+    def _associate(self, boxes):
+        """Move tracks onto this frame's boxes, start tracks for new faces, drop lost ones"""
+        pairs = sorted(
+            ((self.iou(track['box'], box), t, b) for t, track in enumerate(self.tracks) for b, box in enumerate(boxes)),
+            reverse=True
+        )
+        matched_tracks, matched_boxes = set(), set()
+        for overlap, t, b in pairs:
+            if overlap < self.track_iou:
+                break
+            if t in matched_tracks or b in matched_boxes:
+                continue
+            matched_tracks.add(t)
+            matched_boxes.add(b)
+            self.tracks[t].update(box=boxes[b], misses=0)
+
+        for t, track in enumerate(self.tracks):
+            if t not in matched_tracks:
+                track['misses'] += 1
+        self.tracks = [track for track in self.tracks if track['misses'] <= self.max_misses]
+
+        for b, box in enumerate(boxes):
+            if b not in matched_boxes:
+                self.tracks.append({
+                    'track_id': self.next_track, 'box': box, 'misses': 0,
+                    'encoded_box': None, 'encoded_at': None, 'match': None,
+                    'votes': {}, 'identified': False, 'reported_unknown': False
+                })
+                self.next_track += 1
+
+    def update(self, image_array, timings=None):
+        """Process one decoded frame and return the events it produced"""
+        index = self.frames
+        self.frames += 1
+        if index % self.detect_interval == 0 or not self.tracks:
+            # dlib runs in this thread, but under the inference pool's admission bound
+            with self.service.inference_slot():
+                boxes = self.service.locate_faces(image_array, timings)
+            self._associate(boxes)
+
+        visible = [track for track in self.tracks if not track['misses']]
+        self.face_frames += len(visible)
+        stale = [
+            track for track in visible
+            if track['encoded_box'] is None
+            or not (track['identified'] or track['reported_unknown'])
+            or self.iou(track['box'], track['encoded_box']) < self.reencode_iou
+            or index - track['encoded_at'] >= self.reencode_interval
+        ]
+        if stale:
+            with self.service.inference_slot():
+                encodings = self.service.encode_faces(image_array, [track['box'] for track in stale], timings)
+            with timed(timings, 'match'):
+                matches = self.service.search_many(encodings, 1, False)
+            for track, match in zip(stale, matches):
+                candidates = self.service.format_candidates(match)
+                track.update(
+                    encoded_box=track['box'], encoded_at=index,
+                    match=candidates[0] if candidates and candidates[0]['match'] else None
+                )
+            self.encoded += len(stale)
+
+        events = []
+        for track in visible:
+            # A cached match repeated on later frames is not new evidence
+            if track['encoded_at'] != index:
+                continue
+            match = track['match']
+            votes = track['votes'].setdefault(match['user_id'] if match else None, [0, 0.0])
+            votes[0] += 1
+            votes[1] += match['confidence'] if match else 0.0
+            if track['identified'] or votes[0] < self.min_frames:
+                continue
+
+            if match:
+                track['identified'] = True
+                self.service.note_matches([match['user_id']])
+                logger.info(f"Stream track {track['track_id']}: user {match['user_id']} over {votes[0]} frames")
+                events.append(self._event(track, 'identified', index, match['user_id'], votes))
+            elif not track['reported_unknown']:
+                track['reported_unknown'] = True
+                events.append(self._event(track, 'unrecognized', index, None, votes))
+        return events
+
+    def _event(self, track, kind, index, user_id, votes):
+        top, right, bottom, left = track['box']
+        return {
+            'event': kind,
+            'frame': index,
+            'track_id': track['track_id'],
+            'user_id': user_id if user_id is not None else 'unknown',
+            # Mean confidence over the frames backing the decision
+            'confidence': round(votes[1] / votes[0], 4),
+            'frames': votes[0],
+            'box': {'top': top, 'right': right, 'bottom': bottom, 'left': left}
+        }
+
+    def describe(self):
+        """Visible tracks with their current box and match, for per-frame events"""
+        return [
+            {
+                'track_id': track['track_id'],
+                'box': dict(zip(('top', 'right', 'bottom', 'left'), track['box'])),
+                'user_id': track['match']['user_id'] if track['match'] else None,
+                'identified': track['identified']
+            }
+            for track in self.tracks if not track['misses']
+        ]
+
+    def stats(self):
+        return {
+            'frames': self.frames,
+            'tracks': self.next_track - 1,
+            'face_frames': self.face_frames,
+            'encoded': self.encoded,
+            # Share of face sightings that needed a new encoding
+            'encode_ratio': round(self.encoded / self.face_frames, 4) if self.face_frames else 0.0
+        }
+
 class FaceRecognitionService:
     """Face recognition service with encoding storage and management"""
-    
-    def __init__(self, data_dir, tolerance=0.6):
+
+    def __init__(self, data_dir, tolerance=0.6, dtype='float64', index=None, index_min_size=10000,
+                 compact_threshold=0.25, max_templates=5, replace_policy='oldest', aggregation='min',
+                 batch_threads=4, decode_max_size=1600, detect_max_size=640,
+                 enroll_profile=None, recognize_profile=None, inference=None, cache=None,
+                 sync=True, commit_window=0.0, quantizer=None, group_max_faces=10,
+                 shard_id=0, shard_count=1, shards=None):
         self.data_dir = data_dir
+        self.shard_id = shard_id
+        self.shard_count = shard_count
+        self.shards = shards
+        self.sync = sync
+        self.inference = inference
+        self.cache = cache
+        self.enroll_profile = enroll_profile or DetectionProfile('enroll', HOGDetector(), jitters=5)
+        self.recognize_profile = recognize_profile or DetectionProfile('recognize', HOGDetector())
+        self.decode_max_size = decode_max_size
+        self.detect_max_size = detect_max_size
+        self.batch_threads = batch_threads
+        self.batch_executor = None
+        self.group_max_faces = group_max_faces
+        self.last_match = MatchLog(data_dir)
         self.tolerance = tolerance
-        self.known_encodings = {}
-        self.load_known_faces()
-    
+        self.compact_threshold = compact_threshold
+        self.max_templates = max_templates
+        self.replace_policy = replace_policy
+        self.aggregation = aggregation
+        self.index_path = os.path.join(data_dir, 'gallery_index.npz')
+        self.index_thread = None
+        self.gallery = FaceGallery(data_dir, dtype=dtype, index=index, index_min_size=index_min_size,
+                                   quantizer=quantizer, autoload=False)
+        self.committer = GroupCommitter(self.gallery, max_templates, replace_policy, sync, commit_window)
+        self.startup = {'mode': None, 'models': 'pending', 'gallery': 'pending', 'error': None, 'seconds': None}
+        self.startup_pid = None
+        self.startup_lock = threading.Lock()
+        self.ready_event = threading.Event()
+        fork_safe_objects.add(self)
+
+    def after_fork(self):
+        """Recreate the startup locks in a forked child, keeping the ready state
+
+        A child forked while the parent's startup thread was importing the
+        models cannot import them itself (the interpreter's per-module import
+        lock stays held by the thread that did not survive the fork), so it
+        fails fast instead of hanging.
+        """
+        self.startup_lock = threading.Lock()
+        ready_event = threading.Event()
+        if self.ready_event.is_set():
+            ready_event.set()
+        elif self.startup['models'] == 'loading':
+            self.startup['models'] = 'failed'
+            self.startup['error'] = ('worker forked while the models were loading; '
+                                     'do not combine STARTUP_MODE=background with gunicorn --preload')
+            ready_event.set()
+        self.ready_event = ready_event
+
+    @property
+    def ready(self):
+        return self.ready_event.is_set() and self.startup['error'] is None
+
+    def start(self, background=False):
+        """Load the face models and the gallery, inline or in a background thread
+
+        Safe to call on every request: it does nothing once loading finished
+        or while it runs in this process, and restarts it in a worker forked
+        from a master that was still loading the gallery (see after_fork for
+        a fork during the model import).
+        """
+        with self.startup_lock:
+            if self.ready_event.is_set() or self.startup_pid == os.getpid():
+                return
+            self.startup_pid = os.getpid()
+            self.startup['mode'] = 'background' if background else 'eager'
+
+        if background:
+            threading.Thread(target=self._load, name='startup', daemon=True).start()
+        else:
+            self._load()
+
+    def _load(self):
+        started = time.perf_counter()
+        stage = 'models'
+        try:
+            self.startup['models'] = 'loading'
+            load_face_recognition()
+            self.startup['models'] = 'ready'
+
+            stage = 'gallery'
+            self.startup['gallery'] = 'loading'
+            self.load_known_faces()
+            self.startup['gallery'] = 'ready'
+        except Exception as e:
+            logger.error(f"Error loading {stage} at startup: {e}")
+            self.startup[stage] = 'failed'
+            self.startup['error'] = str(e)
+        finally:
+            self.startup['seconds'] = round(time.perf_counter() - started, 3)
+            self.ready_event.set()
+
     def load_known_faces(self):
-        """Load all stored face encodings from files"""
-        self.known_encodings = {}
-        
+        """Map the gallery files, importing legacy per-user .npy files on first run"""
         try:
-            for filename in os.listdir(self.data_dir):
-                if filename.endswith('.npy'):
-                    user_id = filename.replace('.npy', '')
-                    file_path = os.path.join(self.data_dir, filename)
-                    
-                    try:
-                        encoding = np.load(file_path)
-                        self.known_encodings[user_id] = encoding
-                        logger.info(f"Loaded face encoding for user {user_id}")
-                    except Exception as e:
-                        logger.error(f"Error loading encoding for user {user_id}: {e}")
-                        
-            logger.info(f"Loaded {len(self.known_encodings)} face encodings")
+            self.gallery.open()
+
+            if not self.gallery.size and any(name.endswith('.npy') for name in os.listdir(self.data_dir)):
+                imported = self.gallery.import_legacy_files(self.data_dir)
+                logger.info(f"Imported {imported} legacy face encodings into the gallery")
+
+            logger.info(f"Loaded {len(self.gallery)} face encodings")
+            self.gallery.load_index(self.index_path)
         except Exception as e:
             logger.error(f"Error loading known faces: {e}")
+
+    def maybe_compact(self):
+        """Compact the gallery once tombstones exceed the configured share of rows"""
+        if self.gallery.tombstones > max(1000, self.gallery.size * self.compact_threshold):
+            self.gallery.compact()
+
+    def schedule_index_build(self):
+        """Retrain the ANN index in the background once the gallery outgrows it"""
+        if not self.gallery.index_needs_training():
+            return
+        if self.index_thread and self.index_thread.is_alive():
+            return
+
+        def build():
+            try:
+                self.gallery.build_index(self.index_path)
+            except Exception as e:
+                logger.error(f"Error building gallery index: {e}")
+
+        self.index_thread = threading.Thread(target=build, name='gallery-index', daemon=True)
+        self.index_thread.start()
     
-    def decode_base64_image(self, base64_string):
-        """Decode base64 image string to PIL Image"""
+    def decode_base64_data(self, base64_string):
+        """Decode a base64 (or data URL) string to raw image bytes"""
         try:
             # Remove data URL prefix if present
             if ',' in base64_string:
                 base64_string = base64_string.split(',')[1]
             
             # Decode base64
-            image_data = base64.b64decode(base64_string)
-            image = Image.open(BytesIO(image_data))
-            
-            # Convert to RGB if needed
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            
-            return np.array(image)
+            return base64.b64decode(base64_string)
         except Exception as e:
             logger.error(f"Error decoding base64 image: {e}")
             return None
     
-    def detect_faces(self, image_array):
-        """Detect faces in image and return face locations and encodings"""
+    def decode_base64_image(self, base64_string, timings=None):
+        """Decode base64 image string to an RGB image array"""
+        image_data = self.decode_base64_data(base64_string)
+        return None if image_data is None else self.decode_image_bytes(image_data, timings)
+    
+    def is_image(self, image_data):
+        """Cheap format check: PIL only parses the header until pixels are accessed"""
+        try:
+            Image.open(BytesIO(image_data))
+            return True
+        except Exception:
+            return False
+    
+    def decode_image_bytes(self, image_data, timings=None):
+        """Decode raw image bytes to an RGB image array"""
+        return self.decode_image_stream(BytesIO(image_data), timings)
+    
+    def decode_image_stream(self, stream, timings=None):
+        """Decode an image straight from a file-like object to an RGB image array
+        
+        JPEGs are decoded in draft mode: libjpeg scales by 1/2, 1/4 or 1/8 while
+        decoding, so phone photos come out no larger than about twice
+        DECODE_MAX_SIZE without paying for a full-resolution decode. EXIF
+        orientation is applied so detection sees upright faces.
+        """
+        try:
+            with timed(timings, 'decode'):
+                image = Image.open(stream)
+                if image.format == 'JPEG' and self.decode_max_size:
+                    # draft() keeps both sides at or above the requested size
+                    shrink = self.decode_max_size / max(image.size)
+                    if shrink < 1:
+                        image.draft('RGB', (int(image.width * shrink), int(image.height * shrink)))
+                
+                if image.getexif().get(0x0112, 1) != 1:
+                    image = ImageOps.exif_transpose(image)
+                
+                # Convert to RGB if needed
+                if image.mode != 'RGB':
+                    image = image.convert('RGB')
+                
+                return np.array(image)
+        except Exception as e:
+            logger.error(f"Error decoding image: {e}")
+            return None
+    
+    def get_batch_executor(self):
+        """Thread pool for decoding and detecting batch images in parallel
+        
+        With an inference pool the threads only wait for its jobs, so they are
+        capped at its worker count: a lone batch then never exhausts the
+        admission slots itself, while a busy pool still answers 503.
+        """
+        if self.batch_executor is None:
+            threads = self.batch_threads
+            if self.inference is not None:
+                threads = min(threads, self.inference.workers)
+            self.batch_executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='batch')
+        return self.batch_executor
+    
+    @contextmanager
+    def inference_slot(self):
+        """Hold an inference admission slot while dlib runs in the calling thread
+        
+        Waits up to the inference timeout for a slot, so inline work counts
+        against the same MAX_WORKERS + INFERENCE_QUEUE_SIZE bound as the pool.
+        """
+        if self.inference is None:
+            yield
+        else:
+            with self.inference.admit(self.inference.timeout):
+                yield
+    
+    def downscale_for_detection(self, image_array):
+        """Shrink the image so its longest side is at most DETECT_MAX_SIZE; returns (array, scale)"""
+        height, width = image_array.shape[:2]
+        if not self.detect_max_size or max(height, width) <= self.detect_max_size:
+            return image_array, 1.0
+        
+        scale = self.detect_max_size / max(height, width)
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        return np.asarray(Image.fromarray(image_array).resize(size, Image.BILINEAR, reducing_gap=2.0)), scale
+    
+    def detect_faces(self, image_array, timings=None, profile=None):
+        """Detect the face in an image; returns (encoding, location, quality, error)
+        
+        Detection runs on a copy downscaled to DETECT_MAX_SIZE; the box is mapped
+        back, scored by the quality gate and, if it passes the profile's
+        `min_quality`, encoded from a padded full-resolution crop. A rejected
+        face returns its quality and a QUALITY_MESSAGES error without encoding.
+        `profile` defaults to the fast recognition profile.
+        """
+        profile = profile or self.recognize_profile
         try:
-            # Find face locations
-            face_locations = face_recognition.face_locations(image_array)
+            face_locations = self.locate_faces(image_array, timings, profile)
             
             if not face_locations:
-                return None, "No face detected in image"
+                return None, None, None, "No face detected in image"
             
             if len(face_locations) > 1:
-                return None, "Multiple faces detected. Please ensure only one face is visible"
+                return None, None, None, "Multiple faces detected. Please ensure only one face is visible"
+            
+            with timed(timings, 'quality'):
+                quality, reason = self.estimate_face_quality(image_array, face_locations[0], profile.min_quality)
+            if quality < profile.min_quality:
+                logger.info(f"Rejected {profile.name} face: {reason} (quality {quality})")
+                return None, face_locations[0], quality, QUALITY_MESSAGES[reason]
             
-            # Get face encodings
-            face_encodings = face_recognition.face_encodings(image_array, face_locations)
+            face_encodings = self.encode_faces(image_array, face_locations, timings, profile)
             
             if not face_encodings:
-                return None, "Could not generate face encoding"
+                return None, None, None, "Could not generate face encoding"
             
-            return face_encodings[0], None
+            return face_encodings[0], face_locations[0], quality, None
         except Exception as e:
             logger.error(f"Error detecting faces: {e}")
-            return None, f"Face detection error: {str(e)}"
+            return None, None, None, f"Face detection error: {str(e)}"
+    
+    def locate_faces(self, image_array, timings=None, profile=None):
+        """Detect on the downscaled copy and return the boxes in full-resolution coordinates"""
+        profile = profile or self.recognize_profile
+        with timed(timings, 'downscale'):
+            small, scale = self.downscale_for_detection(image_array)
+        
+        with timed(timings, 'detect'):
+            face_locations = profile.detector.locate(small)
+        
+        height, width = image_array.shape[:2]
+        return [
+            (
+                max(0, int(top / scale)),
+                min(width, int(round(right / scale))),
+                min(height, int(round(bottom / scale))),
+                max(0, int(left / scale))
+            )
+            for top, right, bottom, left in face_locations
+        ]
+    
+    def encode_faces(self, image_array, locations, timings=None, profile=None):
+        """Encode every located face with a single face_encodings call
+        
+        Only the region around the faces, with margin for the landmark model,
+        is passed to dlib.
+        """
+        profile = profile or self.recognize_profile
+        with timed(timings, 'encode'):
+            height, width = image_array.shape[:2]
+            pad = max(max(bottom - top, right - left) for top, right, bottom, left in locations) // 2
+            crop_top = max(0, min(top for top, _, _, _ in locations) - pad)
+            crop_left = max(0, min(left for _, _, _, left in locations) - pad)
+            crop_bottom = min(height, max(bottom for _, _, bottom, _ in locations) + pad)
+            crop_right = min(width, max(right for _, right, _, _ in locations) + pad)
+            crop = image_array[crop_top:crop_bottom, crop_left:crop_right]
+            return load_face_recognition().face_encodings(
+                crop,
+                [(top - crop_top, right - crop_left, bottom - crop_top, left - crop_left)
+                 for top, right, bottom, left in locations],
+                num_jitters=profile.jitters
+            )
+    
+    def process_image(self, image_data, timings=None, profile=None):
+        """Decode, detect and encode one image; returns (encoding, location, quality, error)"""
+        profile = profile or self.recognize_profile
+        image_array = self.decode_image_bytes(image_data, timings)
+        if image_array is None:
+            return None, None, None, "Invalid image format"
+        
+        encoding, location, quality, error = self.detect_faces(image_array, timings, profile)
+        if error:
+            return None, None, None, error
+        
+        return encoding, location, quality, None
     
-    def register_face(self, user_id, image_array):
-        """Register a new face encoding for a user"""
+    def process_group_image(self, image_data, timings=None):
+        """Decode one frame and encode up to GROUP_MAX_FACES faces; returns (encodings, locations, error)
+        
+        When more faces are found, the largest ones (closest to the camera) are kept.
+        """
+        image_array = self.decode_image_bytes(image_data, timings)
+        if image_array is None:
+            return None, None, "Invalid image format"
+        
         try:
-            encoding, error = self.detect_faces(image_array)
-            if error:
-                return False, error
+            locations = self.locate_faces(image_array, timings)
+            if not locations:
+                return None, None, "No face detected in image"
             
-            # Save encoding to file
-            file_path = os.path.join(self.data_dir, f"{user_id}.npy")
-            np.save(file_path, encoding)
+            locations = sorted(locations, key=lambda box: (box[2] - box[0]) * (box[1] - box[3]), reverse=True)
+            locations = locations[:self.group_max_faces]
+            encodings = self.encode_faces(image_array, locations, timings)
+            if len(encodings) != len(locations):
+                return None, None, "Could not generate face encoding"
             
-            # Update in-memory storage
-            self.known_encodings[str(user_id)] = encoding
+            return encodings, locations, None
+        except Exception as e:
+            logger.error(f"Error detecting faces: {e}")
+            return None, None, f"Face detection error: {str(e)}"
+    
+    def analyze_image(self, image_data, timings=None, profile=None, wait=0):
+        """process_image through the embedding cache and, when configured, the inference pool
+        
+        `wait` is how long to wait for a free inference slot (None: no limit)
+        before giving up with InferenceBusyError.
+        """
+        profile = profile or self.recognize_profile
+        key = None
+        if self.cache is not None:
+            key = self.cache.key(image_data, profile)
+            with timed(timings, 'cache'):
+                cached = self.cache.get(key)
+            if cached is not None:
+                encoding, location, quality = cached
+                return encoding, location, quality, None
+        
+        if self.inference is None:
+            result = self.process_image(image_data, timings, profile)
+        else:
+            # Round trip including queueing and pickling; the job's own stages are merged below
+            with timed(timings, 'inference'):
+                *result, job_timings = self.inference.run(run_inference_job, image_data, profile.name, wait=wait)
+            if timings is not None:
+                timings.update(job_timings)
+        
+        encoding, location, quality, error = result
+        if key is not None and not error:
+            self.cache.put(key, (encoding, location, quality))
+        return encoding, location, quality, error
+    
+    def estimate_face_quality(self, image_array, location, min_quality=0.0):
+        """Score a detected face in [0, 1]; returns (quality, reason of the weakest check)
+        
+        Box size, exposure, contrast and sharpness (variance of the Laplacian)
+        are measured on a copy of the crop sampled down to ~128 px. Pose is
+        only estimated, from the 5-point landmarks, when those already pass
+        `min_quality`. The quality is the lowest check score, so every check
+        has to clear the threshold on its own.
+        """
+        top, right, bottom, left = location
+        side = min(bottom - top, right - left)
+        crop = image_array[max(top, 0):bottom, max(left, 0):right]
+        if crop.shape[0] < 3 or crop.shape[1] < 3:
+            return 0.0, 'face_too_small'
+        
+        step = max(1, side // 128)
+        gray = crop[::step, ::step]
+        gray = gray.mean(axis=2) if gray.ndim == 3 else gray.astype(np.float64)
+        brightness = gray.mean()
+        laplacian = (
+            4 * gray[1:-1, 1:-1]
+            - gray[:-2, 1:-1] - gray[2:, 1:-1]
+            - gray[1:-1, :-2] - gray[1:-1, 2:]
+        )
+        scores = {
+            'face_too_small': min(1.0, side / 150),
+            # Full score for a mean grey level between 80 and 180
+            'too_dark' if brightness < 130 else 'too_bright': float(np.clip(min(brightness - 30, 230 - brightness) / 50, 0, 1)),
+            'low_contrast': min(1.0, gray.std() / 30),
+            'blurry': min(1.0, laplacian.var() / 500) if laplacian.size else 0.0,
+        }
+        if min_quality > 0 and min(scores.values()) >= min_quality:
+            scores.update(self.estimate_pose(image_array, location))
+        
+        reason = min(scores, key=scores.get)
+        return round(float(scores[reason]), 4), reason
+    
+    def estimate_pose(self, image_array, location):
+        """Frontal-pose scores: yaw from the nose offset along the eye line, roll from its angle"""
+        landmarks = load_face_recognition().face_landmarks(image_array, [location], model='small')
+        if not landmarks:
+            return {}
+        
+        points = landmarks[0]
+        left_eye = np.mean(points['left_eye'], axis=0)
+        right_eye = np.mean(points['right_eye'], axis=0)
+        nose = np.mean(points['nose_tip'], axis=0)
+        eyes = right_eye - left_eye
+        distance = float(np.dot(eyes, eyes))
+        if distance < 1:
+            return {}
+        
+        yaw = abs(np.dot(nose - (left_eye + right_eye) / 2, eyes)) / distance
+        roll = np.degrees(np.arctan2(abs(eyes[1]), abs(eyes[0])))
+        return {
+            'face_turned': float(np.clip(1 - yaw / 0.6, 0, 1)),
+            'face_tilted': float(np.clip(1 - roll / 60, 0, 1))
+        }
+    
+    def register_face(self, user_id, image_data, replace=False, timings=None):
+        """Add a face template for a user, keeping at most MAX_FACES_PER_USER"""
+        try:
+            if user_id_error(user_id):
+                return False, user_id_error(user_id)
+            if not self.owns(user_id):
+                return False, f"User belongs to shard {shard_for(user_id, self.shard_count)}"
             
-            # Save metadata
-            metadata = {
-                'user_id': user_id,
-                'registered_at': datetime.now().isoformat(),
-                'encoding_shape': encoding.shape,
-                'encoding_count': 1
-            }
+            encoding, _, quality, error = self.analyze_image(image_data, timings, self.enroll_profile)
+            if error:
+                return False, error
             
-            metadata_path = os.path.join(self.data_dir, f"{user_id}_meta.json")
-            with open(metadata_path, 'w') as f:
-                json.dump(metadata, f)
+            # Append encoding and metadata to the gallery files, sharing the fsync with concurrent enrollments
+            with timed(timings, 'store'):
+                self.committer.commit([(user_id, encoding, None, quality)], replace)
+            self.schedule_index_build()
             
             logger.info(f"Face registered successfully for user {user_id}")
             return True, "Face registered successfully"
             
+        except InferenceError:
+            raise
         except Exception as e:
             logger.error(f"Error registering face for user {user_id}: {e}")
             return False, f"Registration error: {str(e)}"
     
-    def recognize_face(self, image_array):
-        """Recognize a face in the image"""
+    def format_candidates(self, matches):
+        """Turn (user_id, distance) pairs into candidate dicts"""
+        return [
+            {
+                'user_id': public_user_id(user_id),
+                'distance': round(distance, 4),
+                # Convert to confidence (higher is better)
+                'confidence': round(1 - distance, 4),
+                'match': distance <= self.tolerance
+            }
+            for user_id, distance in matches
+        ]
+    
+    def owns(self, user_id):
+        """Whether this node stores the user's templates (always, unless sharded)"""
+        return self.shard_count <= 1 or shard_for(user_id, self.shard_count) == self.shard_id
+    
+    def has_faces(self):
+        return bool(self.shards) or len(self.gallery) > 0
+    
+    def search_many(self, encodings, top_k=1, exact=False):
+        """Match encodings against the local gallery, or against every shard on a coordinator"""
+        if self.shards:
+            return self.shards.search_many(encodings, top_k, exact)
+        return self.gallery.search_many(encodings, top_k, exact, self.aggregation)
+    
+    def note_matches(self, user_ids):
+        """Record when users were last recognized or verified"""
+        self.last_match.record(user_ids)
+    
+    def find_candidates(self, encoding, top_k=1, exact=False):
+        """Match an encoding against the gallery and return the nearest users"""
+        return self.format_candidates(self.search_many([encoding], top_k, exact)[0])
+
+    def recognize_face(self, image_data, top_k=1, exact=False, timings=None):
+        """Recognize a face in the image, returning the best match and top-k candidates"""
         try:
-            if not self.known_encodings:
-                return None, 0.0, "No registered faces found"
+            if not self.has_faces():
+                return None, 0.0, "No registered faces found", []
             
-            encoding, error = self.detect_faces(image_array)
+            encoding, _, _, error = self.analyze_image(image_data, timings)
+            if error:
+                return None, 0.0, error, []
+            
+            # Compare with all known faces in a single batched distance computation
+            with timed(timings, 'match'):
+                candidates = self.find_candidates(encoding, top_k, exact)
+            best = candidates[0] if candidates else None
+            
+            if best and best['match']:
+                self.note_matches([best['user_id']])
+                logger.info(f"Face recognized: user {best['user_id']} with confidence {best['confidence']:.2f}")
+                return best['user_id'], best['confidence'], "Face recognized successfully", candidates
+            else:
+                return None, 0.0, "Face not recognized", candidates
+                
+        except InferenceError:
+            raise
+        except Exception as e:
+            logger.error(f"Error recognizing face: {e}")
+            return None, 0.0, f"Recognition error: {str(e)}", []
+    
+    def recognize_group(self, image_data, top_k=1, exact=False, timings=None):
+        """Recognize every face in one frame, matching all encodings in one pass
+        
+        Returns (faces, error). Each face is a (user_id, confidence, location,
+        candidates) tuple, largest face first; a user is only assigned to the
+        face closest to their templates.
+        """
+        try:
+            if not self.has_faces():
+                return None, "No registered faces found"
+            
+            if self.inference is None:
+                encodings, locations, error = self.process_group_image(image_data, timings)
+            else:
+                with timed(timings, 'inference'):
+                    encodings, locations, error, job_timings = self.inference.run(run_group_inference_job, image_data)
+                if timings is not None:
+                    timings.update(job_timings)
+            if error:
+                return None, error
+            
+            with timed(timings, 'match'):
+                matches = self.search_many(encodings, top_k, exact)
+            candidates = [self.format_candidates(match) for match in matches]
+            
+            # Closest faces claim their user first
+            best = [c[0] if c and c[0]['match'] else None for c in candidates]
+            claimed = set()
+            faces = [None] * len(best)
+            for i in sorted(range(len(best)), key=lambda i: best[i]['distance'] if best[i] else np.inf):
+                if best[i] and best[i]['user_id'] not in claimed:
+                    claimed.add(best[i]['user_id'])
+                    faces[i] = (best[i]['user_id'], best[i]['confidence'], locations[i], candidates[i])
+                else:
+                    faces[i] = (None, 0.0, locations[i], candidates[i])
+            
+            if claimed:
+                self.note_matches(claimed)
+                logger.info(f"Group frame: recognized users {sorted(claimed, key=str)} among {len(faces)} faces")
+            return faces, None
+            
+        except InferenceError:
+            raise
+        except Exception as e:
+            logger.error(f"Error recognizing group frame: {e}")
+            return None, f"Recognition error: {str(e)}"
+    
+    def verify_face(self, user_id, image_data, timings=None):
+        """Compare the face in the image with one user's templates (1:1)
+        
+        Returns (verified, distance, confidence, message); distance is None when
+        no comparison could be made.
+        """
+        try:
+            if str(user_id) not in self.gallery:
+                return False, None, 0.0, "No face registered for user"
+            
+            encoding, _, _, error = self.analyze_image(image_data, timings)
+            if error:
+                return False, None, 0.0, error
+            
+            with timed(timings, 'match'):
+                distance = self.gallery.verify(user_id, encoding, self.aggregation)
+            if distance is None:
+                return False, None, 0.0, "No face registered for user"
+            
+            confidence = round(1 - distance, 4)
+            if distance <= self.tolerance:
+                self.note_matches([user_id])
+                logger.info(f"Face verified for user {user_id} with confidence {confidence:.2f}")
+                return True, distance, confidence, "Face verified successfully"
+            return False, distance, confidence, "Face does not match user"
+            
+        except InferenceError:
+            raise
+        except Exception as e:
+            logger.error(f"Error verifying face for user {user_id}: {e}")
+            return False, None, 0.0, f"Verification error: {str(e)}"
+    
+    def recognize_batch(self, blobs, top_k=1, exact=False, timings=None):
+        """Recognize one face per image, matching every encoding in one pass
+        
+        `blobs` are raw image bytes (None for undecodable entries). Returns one
+        (user_id, confidence, message, candidates) tuple per image.
+        """
+        if not self.has_faces():
+            return [(None, 0.0, "No registered faces found", []) for _ in blobs]
+        
+        with timed(timings, 'analyze'):
+            detections = list(self.get_batch_executor().map(
+                lambda blob: (None, None, None, "Invalid image format") if blob is None
+                else self.analyze_image(blob),
+                blobs
+            ))
+        
+        detected = [i for i, (_, _, _, error) in enumerate(detections) if not error]
+        with timed(timings, 'match'):
+            matches = self.search_many([detections[i][0] for i in detected], top_k, exact) if detected else []
+        matches = dict(zip(detected, matches))
+        
+        results = []
+        for i, (_, _, _, error) in enumerate(detections):
             if error:
-                return None, 0.0, error
+                results.append((None, 0.0, error, []))
+                continue
             
-            # Compare with known faces
-            best_match_user = None
-            best_confidence = 0.0
-            
-            for user_id, known_encoding in self.known_encodings.items():
-                # Calculate face distance (lower is better)
-                face_distance = face_recognition.face_distance([known_encoding], encoding)[0]
-                
-                # Convert to confidence (higher is better)
-                confidence = 1 - face_distance
-                
-                # Check if it's a match and better than previous matches
-                if face_distance <= self.tolerance and confidence > best_confidence:
-                    best_match_user = user_id
-                    best_confidence = confidence
-            
-            if best_match_user:
-                logger.info(f"Face recognized: user {best_match_user} with confidence {best_confidence:.2f}")
-                return best_match_user, best_confidence, "Face recognized successfully"
+            candidates = self.format_candidates(matches[i])
+            best = candidates[0] if candidates else None
+            if best and best['match']:
+                self.note_matches([best['user_id']])
+                results.append((best['user_id'], best['confidence'], "Face recognized successfully", candidates))
             else:
-                return None, 0.0, "Face not recognized"
-                
-        except Exception as e:
-            logger.error(f"Error recognizing face: {e}")
-            return None, 0.0, f"Recognition error: {str(e)}"
+                results.append((None, 0.0, "Face not recognized", candidates))
+        
+        return results
     
     def get_user_status(self, user_id):
-        """Get registration status for a user"""
-        file_path = os.path.join(self.data_dir, f"{user_id}.npy")
-        metadata_path = os.path.join(self.data_dir, f"{user_id}_meta.json")
+        """Get registration status for a user from the in-memory metadata table"""
+        summary = self.gallery.user_summary(user_id)
+        last_match = self.last_match.get(user_id)
         
-        if os.path.exists(file_path):
-            metadata = {}
-            if os.path.exists(metadata_path):
-                try:
-                    with open(metadata_path, 'r') as f:
-                        metadata = json.load(f)
-                except Exception as e:
-                    logger.error(f"Error reading metadata for user {user_id}: {e}")
-            
+        if summary is not None:
+            count, registered_at, quality = summary
             return {
                 'registered': True,
-                'last_updated': metadata.get('registered_at'),
-                'encoding_count': metadata.get('encoding_count', 1)
+                'last_updated': datetime.fromtimestamp(registered_at).isoformat(),
+                'encoding_count': count,
+                'quality': None if quality is None else round(quality, 3),
+                'last_match_at': datetime.fromtimestamp(last_match).isoformat() if last_match else None
             }
         else:
             return {
                 'registered': False,
                 'last_updated': None,
-                'encoding_count': 0
+                'encoding_count': 0,
+                'quality': None,
+                'last_match_at': None
             }
     
     def delete_user_face(self, user_id):
@@ -229,12 +3005,14 @@ class FaceRecognitionService:
                 os.remove(metadata_path)
                 deleted_files.append(metadata_path)
             
-            # Remove from memory
-            if str(user_id) in self.known_encodings:
-                del self.known_encodings[str(user_id)]
+            # Tombstone the gallery row
+            removed = self.gallery.remove(user_id, sync=self.sync)
+            self.last_match.forget(user_id)
+            if removed:
+                self.maybe_compact()
             
-            if deleted_files:
-                logger.info(f"Deleted face data for user {user_id}: {deleted_files}")
+            if removed or deleted_files:
+                logger.info(f"Deleted face data for user {user_id} (legacy files: {deleted_files})")
                 return True, f"Face data deleted successfully"
             else:
                 return False, "No face data found for user"
@@ -246,61 +3024,352 @@ class FaceRecognitionService:
 # Initialize face recognition service
 face_service = FaceRecognitionService(
     app.config['FACE_DATA_DIR'], 
-    app.config['RECOGNITION_TOLERANCE']
+    app.config['RECOGNITION_TOLERANCE'],
+    app.config['GALLERY_DTYPE'],
+    create_index(app.config['GALLERY_INDEX'], app.config['INDEX_NLIST'], app.config['INDEX_NPROBE']),
+    app.config['INDEX_MIN_SIZE'],
+    app.config['GALLERY_COMPACT_THRESHOLD'],
+    app.config['MAX_FACES_PER_USER'],
+    app.config['TEMPLATE_REPLACE_POLICY'],
+    app.config['TEMPLATE_AGGREGATION'],
+    app.config['BATCH_THREADS'],
+    app.config['DECODE_MAX_SIZE'],
+    app.config['DETECT_MAX_SIZE'],
+    DetectionProfile(
+        'enroll',
+        create_detector(app.config['ENROLL_DETECTOR'], app.config['ENROLL_UPSAMPLE']),
+        app.config['ENROLL_JITTERS'],
+        app.config['FACE_QUALITY_THRESHOLD']
+    ),
+    DetectionProfile(
+        'recognize',
+        create_detector(app.config['RECOGNIZE_DETECTOR'], app.config['RECOGNIZE_UPSAMPLE']),
+        app.config['RECOGNIZE_JITTERS'],
+        app.config['RECOGNITION_QUALITY_THRESHOLD']
+    ),
+    InferenceExecutor(
+        app.config['MAX_WORKERS'],
+        app.config['INFERENCE_QUEUE_SIZE'],
+        app.config['WORKER_TIMEOUT']
+    ) if app.config['MAX_WORKERS'] > 0 else None,
+    EmbeddingCache(
+        app.config['CACHE_MAX_ENTRIES'],
+        app.config['CACHE_TIMEOUT'],
+        create_cache_backend(app.config['REDIS_URL'], app.config['CACHE_MAX_ENTRIES'])
+    ) if app.config['CACHE_MAX_ENTRIES'] > 0 else None,
+    app.config['GALLERY_SYNC'],
+    app.config['GROUP_COMMIT_WINDOW_MS'] / 1000,
+    create_quantizer(app.config['GALLERY_QUANTIZE'], app.config['QUANTIZE_RERANK']),
+    app.config['GROUP_MAX_FACES'],
+    app.config['SHARD_ID'],
+    app.config['SHARD_COUNT'],
+    ShardRouter(app.config['SHARD_URLS'], app.config['SHARD_TIMEOUT']) if app.config['SHARD_URLS'] else None
+)
+
+metrics = MetricsRegistry()
+
+# With gunicorn --preload this runs once in the master and workers inherit the loaded state;
+# tools importing this module (enroll_bulk.py) set STARTUP_MODE=manual and load what they use
+if app.config['STARTUP_MODE'] != 'manual':
+    face_service.start(background=app.config['STARTUP_MODE'] == 'background')
+
+enrollment_queue = EnrollmentQueue(
+    face_service,
+    os.path.join(app.config['FACE_DATA_DIR'], 'jobs'),
+    app.config['ENROLL_WORKERS'],
+    app.config['ENROLL_QUEUE_SIZE'],
+    app.config['ENROLL_BATCH_SIZE'],
+    app.config['ENROLL_JOB_TTL']
 )
 
+@app.before_request
+def start_request_timer():
+    """Start the per-request clock and the stage timings collected by the handlers"""
+    g.request_started = time.perf_counter()
+    g.timings = {}
+
+@app.after_request
+def record_request_metrics(response):
+    """Feed the request's total and per-stage latency into the metrics histograms"""
+    started = g.get('request_started')
+    if started is not None:
+        metrics.record_request(
+            request.endpoint or 'unmatched', response.status_code,
+            time.perf_counter() - started, g.get('timings')
+        )
+    return response
+
+@app.before_request
+def require_ready():
+    """Answer 503 until the models and the gallery are loaded"""
+    if request.endpoint in ('health_check', 'get_metrics'):
+        return None
+    face_service.start(background=app.config['STARTUP_MODE'] == 'background')
+    if face_service.ready:
+        return None
+    if face_service.ready_event.is_set():
+        message = f"Server failed to start: {face_service.startup['error']}"
+    else:
+        message = 'Server is starting, please retry shortly'
+    return jsonify({'success': False, 'message': message}), 503
+
+@app.before_request
+def refresh_gallery():
+    """Pick up registrations and deletions made by other gunicorn workers"""
+    try:
+        face_service.gallery.refresh()
+    except Exception as e:
+        logger.error(f"Error refreshing gallery: {e}")
+
+# Per-user requests a coordinator hands to the shard owning the user
+SHARD_ROUTED_ENDPOINTS = ('register_face', 'verify_face', 'get_face_status', 'delete_face')
+
+@app.before_request
+def route_to_shard():
+    """On a coordinator, proxy per-user requests to the user's shard"""
+    if not face_service.shards:
+        return None
+    if request.endpoint == 'submit_enrollment_job':
+        return jsonify({
+            'success': False,
+            'message': 'Enrollment jobs are not split across shards; submit them to each shard'
+        }), 400
+    if request.endpoint not in SHARD_ROUTED_ENDPOINTS:
+        return None
+    
+    data = request.get_json(silent=True) if request.is_json else None
+    user_id = (request.view_args or {}).get('user_id')
+    # Explicit None checks: user_id 0 is a valid id
+    for source in (request.args, request.form, data if isinstance(data, dict) else {}):
+        if user_id is None:
+            user_id = source.get('user_id')
+    if user_id is None:
+        # Let the endpoint report the missing field
+        return None
+    
+    kwargs = {'params': request.args}
+    if request.files:
+        kwargs['data'] = request.form
+        kwargs['files'] = [
+            (name, (file.filename, file.stream, file.mimetype))
+            for name, file in request.files.items(multi=True)
+        ]
+    elif data is not None:
+        kwargs['json'] = data
+    else:
+        kwargs['data'] = request.get_data()
+        if request.content_type:
+            kwargs['headers'] = {'Content-Type': request.content_type}
+    
+    try:
+        response = face_service.shards.forward(user_id, request.method, request.path, **kwargs)
+    except ShardUnavailableError as e:
+        logger.warning(f"{request.endpoint} not forwarded: {e}")
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), e.status_code
+    
+    if response.ok and request.endpoint == 'get_face_status':
+        return jsonify(merge_last_match(response.json()))
+    if response.ok and request.endpoint == 'delete_face':
+        face_service.last_match.forget(user_id)
+    return Response(response.content, status=response.status_code,
+                    content_type=response.headers.get('Content-Type', 'application/json'))
+
+def merge_last_match(status):
+    """Fold the coordinator's own matches into a status answered by a shard
+    
+    Recognition is matched on the coordinator, so only its MatchLog knows
+    about it; the shard itself records /verify. The later of the two wins.
+    """
+    matched_at = face_service.last_match.get(status.get('user_id'))
+    if matched_at and status.get('registered'):
+        remote = status.get('last_match_at')
+        if remote is None or datetime.fromisoformat(remote).timestamp() < matched_at:
+            status['last_match_at'] = datetime.fromtimestamp(matched_at).isoformat()
+    return status
+
 @app.route('/health', methods=['GET'])
 def health_check():
-    """Health check endpoint"""
+    """Health check endpoint; 503 until the models and the gallery are loaded"""
+    face_service.start(background=app.config['STARTUP_MODE'] == 'background')
+    if face_service.ready:
+        status = 'online'
+    else:
+        status = 'failed' if face_service.ready_event.is_set() else 'starting'
     return jsonify({
-        'status': 'online',
+        'status': status,
+        'ready': face_service.ready,
+        'startup': face_service.startup,
         'service': 'Face Recognition Server',
         'version': '1.0.0',
         'timestamp': datetime.now().isoformat(),
-        'registered_faces': len(face_service.known_encodings),
+        'registered_faces': len(face_service.gallery),
+        'gallery_sequence': face_service.gallery.seen_sequence,
         'face_data_dir': app.config['FACE_DATA_DIR'],
         'recognition_tolerance': app.config['RECOGNITION_TOLERANCE']
-    })
+    }), 200 if face_service.ready else 503
+
+def is_truthy(value):
+    """Interpret JSON booleans as well as form/query strings like 'true' or '1'"""
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes', 'on')
+    return bool(value)
+
+def parse_top_k(value):
+    """top_k from a request field clamped to 1..MAX_TOP_K, or None if it is not an integer"""
+    try:
+        top_k = int(value)
+    except (TypeError, ValueError):
+        return None
+    return max(1, min(top_k, app.config['MAX_TOP_K']))
+
+def read_image_request(required=('photo',), timings=None):
+    """Read the photo and fields of a JSON, multipart or raw image request
+    
+    Accepts the JSON/base64 contract, a multipart `photo` file part with form
+    fields, or a raw `image/*` body with fields in the query string. The
+    MAX_IMAGE_SIZE limit is checked against Content-Length before the body is
+    read. Returns (image_data, fields, error_response) with the raw image bytes.
+    """
+    max_size = app.config['MAX_IMAGE_SIZE']
+    too_large = (jsonify({
+        'success': False,
+        'message': f'Image too large: maximum {max_size} bytes'
+    }), 413)
+    if len(required) > 1:
+        missing_message = f"Missing required fields: {' and '.join(required)}"
+    else:
+        missing_message = f'Missing required field: {required[0]}'
+    missing = (jsonify({'success': False, 'message': missing_message}), 400)
+    content_type = request.mimetype or ''
+    
+    if content_type.startswith('image/') or content_type == 'application/octet-stream':
+        if request.content_length is not None and request.content_length > max_size:
+            return None, {}, too_large
+        
+        fields = request.args.to_dict()
+        # Bounded read also covers chunked bodies without Content-Length
+        with timed(timings, 'read'):
+            image_data = request.stream.read(max_size + 1)
+        if len(image_data) > max_size:
+            return None, fields, too_large
+        if not image_data:
+            return None, fields, missing
+    
+    elif content_type == 'multipart/form-data':
+        # Parsing form/files spools the whole body, so the size must be known first
+        if request.content_length is None:
+            return None, {}, (jsonify({
+                'success': False,
+                'message': 'Content-Length required for multipart uploads'
+            }), 411)
+        # Leave room for the other form fields and part headers
+        if request.content_length > max_size + 65536:
+            return None, {}, too_large
+        
+        fields = request.form.to_dict()
+        photo = request.files.get('photo')
+        if photo is None:
+            return None, fields, missing
+        
+        photo.stream.seek(0, os.SEEK_END)
+        if photo.stream.tell() > max_size:
+            return None, fields, too_large
+        photo.stream.seek(0)
+        with timed(timings, 'read'):
+            image_data = photo.read()
+    
+    else:
+        fields = request.get_json(silent=True)
+        if not isinstance(fields, dict) or 'photo' not in fields:
+            return None, fields or {}, missing
+        
+        if not isinstance(fields['photo'], str):
+            image_data = None
+        # Base64 inflates the payload by a third
+        elif len(fields['photo']) * 3 // 4 > max_size:
+            return None, fields, too_large
+        else:
+            with timed(timings, 'read'):
+                image_data = face_service.decode_base64_data(fields['photo'])
+    
+    if any(field not in fields for field in required if field != 'photo'):
+        return None, fields, missing
+    
+    if not image_data or not face_service.is_image(image_data):
+        return None, fields, (jsonify({
+            'success': False,
+            'message': 'Invalid image format'
+        }), 400)
+    
+    return image_data, fields, None
+
+def read_exactly(stream, size):
+    """Read `size` bytes from a (possibly chunked) stream; shorter only at end of stream"""
+    data = b''
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+def read_frames(stream, max_size):
+    """Yield the frames of a body made of 4-byte big-endian lengths, each followed by one image"""
+    while True:
+        header = read_exactly(stream, 4)
+        if not header:
+            return
+        if len(header) < 4:
+            raise ValueError("Truncated frame header")
+        size = int.from_bytes(header, 'big')
+        if size > max_size:
+            raise ValueError(f"Frame too large: maximum {max_size} bytes")
+        frame = read_exactly(stream, size)
+        if len(frame) < size:
+            raise ValueError("Truncated frame")
+        yield frame
 
 @app.route('/register-face', methods=['POST'])
 def register_face():
     """Register a new face for a user"""
     try:
-        data = request.get_json()
-        
-        if not data or 'user_id' not in data or 'photo' not in data:
-            return jsonify({
-                'success': False,
-                'message': 'Missing required fields: user_id and photo'
-            }), 400
+        timings = g.timings
+        image_data, data, error = read_image_request(('user_id', 'photo'), timings)
+        if error:
+            return error
         
         user_id = data['user_id']
-        photo_base64 = data['photo']
-        
-        # Decode image
-        image_array = face_service.decode_base64_image(photo_base64)
-        if image_array is None:
-            return jsonify({
-                'success': False,
-                'message': 'Invalid image format'
-            }), 400
+        replace = is_truthy(data.get('replace', False))
         
         # Register face
-        success, message = face_service.register_face(user_id, image_array)
+        success, message = face_service.register_face(user_id, image_data, replace, timings)
         
         if success:
             return jsonify({
                 'success': True,
                 'message': message,
                 'user_id': user_id,
-                'registered_at': datetime.now().isoformat()
+                'encoding_count': face_service.get_user_status(user_id)['encoding_count'],
+                'registered_at': datetime.now().isoformat(),
+                'timings_ms': timings
             })
         else:
             return jsonify({
                 'success': False,
-                'message': message
+                'message': message,
+                'reason': rejection_reason(message),
+                'timings_ms': timings
             }), 400
             
+    except InferenceError as e:
+        logger.warning(f"register_face rejected: {e}")
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), e.status_code
     except Exception as e:
         logger.error(f"Error in register_face endpoint: {traceback.format_exc()}")
         return jsonify({
@@ -312,43 +3381,58 @@ def register_face():
 def recognize_face():
     """Recognize a face in the provided image"""
     try:
-        data = request.get_json()
+        timings = g.timings
+        image_data, data, error = read_image_request(timings=timings)
+        if error:
+            return error
         
-        if not data or 'photo' not in data:
+        top_k = parse_top_k(data.get('top_k', 1))
+        if top_k is None:
             return jsonify({
                 'success': False,
-                'message': 'Missing required field: photo'
+                'message': 'top_k must be an integer'
             }), 400
+        exact = is_truthy(data.get('exact', False))
         
-        photo_base64 = data['photo']
-        
-        # Decode image
-        image_array = face_service.decode_base64_image(photo_base64)
-        if image_array is None:
-            return jsonify({
-                'success': False,
-                'message': 'Invalid image format'
-            }), 400
+        if is_truthy(data.get('group', False)):
+            return recognize_group(image_data, top_k, exact, timings)
         
         # Recognize face
-        user_id, confidence, message = face_service.recognize_face(image_array)
+        user_id, confidence, message, candidates = face_service.recognize_face(image_data, top_k, exact, timings)
         
-        if user_id:
-            return jsonify({
+        if user_id is not None:
+            response = {
                 'success': True,
                 'message': message,
-                'user_id': int(user_id),
+                'user_id': user_id,
                 'confidence': round(confidence, 4),
                 'recognized_at': datetime.now().isoformat()
-            })
+            }
+            status_code = 200
         else:
-            return jsonify({
+            response = {
                 'success': False,
                 'message': message,
+                'reason': rejection_reason(message),
                 'user_id': 'unknown',
                 'confidence': 0.0
-            }), 404
+            }
+            status_code = 404
+        
+        if top_k > 1:
+            response['candidates'] = candidates
+        if face_service.shards:
+            response['shards'] = face_service.shards.report()
+        response['timings_ms'] = timings
+        
+        return jsonify(response), status_code
             
+    except InferenceError as e:
+        logger.warning(f"recognize rejected: {e}")
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), e.status_code
     except Exception as e:
         logger.error(f"Error in recognize endpoint: {traceback.format_exc()}")
         return jsonify({
@@ -356,6 +3440,356 @@ def recognize_face():
             'message': f'Server error: {str(e)}'
         }), 500
 
+def recognize_group(image_data, top_k, exact, timings):
+    """Group mode of /recognize: one entry per detected face, with its box"""
+    faces, error = face_service.recognize_group(image_data, top_k, exact, timings)
+    if error:
+        return jsonify({
+            'success': False,
+            'message': error,
+            'faces': [],
+            'timings_ms': timings
+        }), 404 if error == "No registered faces found" else 400
+    
+    results = []
+    for user_id, confidence, (top, right, bottom, left), candidates in faces:
+        result = {
+            'user_id': user_id if user_id is not None else 'unknown',
+            'confidence': round(confidence, 4),
+            'box': {'top': top, 'right': right, 'bottom': bottom, 'left': left},
+            'message': "Face recognized successfully" if user_id is not None else "Face not recognized"
+        }
+        if top_k > 1:
+            result['candidates'] = candidates
+        results.append(result)
+    
+    recognized = sum(1 for user_id, _, _, _ in faces if user_id is not None)
+    response = {
+        'success': recognized > 0,
+        'message': f"Recognized {recognized} of {len(faces)} faces",
+        'faces': results,
+        'recognized': recognized,
+        'total': len(faces),
+        'recognized_at': datetime.now().isoformat(),
+        'timings_ms': timings
+    }
+    if face_service.shards:
+        response['shards'] = face_service.shards.report()
+    return jsonify(response), 200 if recognized else 404
+
+@app.route('/verify', methods=['POST'])
+def verify_face():
+    """Verify that the photo shows the given user, comparing only that user's templates"""
+    try:
+        timings = g.timings
+        image_data, data, error = read_image_request(('user_id', 'photo'), timings)
+        if error:
+            return error
+        
+        user_id = data['user_id']
+        verified, distance, confidence, message = face_service.verify_face(user_id, image_data, timings)
+        
+        if distance is None:
+            status_code = 404 if message == "No face registered for user" else 400
+            return jsonify({
+                'success': False,
+                'verified': False,
+                'message': message,
+                'reason': rejection_reason(message),
+                'user_id': user_id,
+                'timings_ms': timings
+            }), status_code
+        
+        return jsonify({
+            'success': verified,
+            'verified': verified,
+            'message': message,
+            'user_id': user_id,
+            'distance': round(distance, 4),
+            'confidence': confidence,
+            'tolerance': app.config['RECOGNITION_TOLERANCE'],
+            'verified_at': datetime.now().isoformat(),
+            'timings_ms': timings
+        })
+        
+    except InferenceError as e:
+        logger.warning(f"verify rejected: {e}")
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), e.status_code
+    except Exception as e:
+        logger.error(f"Error in verify endpoint: {traceback.format_exc()}")
+        return jsonify({
+            'success': False,
+            'message': f'Server error: {str(e)}'
+        }), 500
+
+@app.route('/recognize-stream', methods=['POST'])
+def recognize_stream():
+    """Recognize the faces in a stream of frames from one camera, answering with NDJSON events
+    
+    The body is a (chunked) sequence of length-prefixed images; events are
+    written as soon as the frame producing them has been processed.
+    """
+    try:
+        if not face_service.has_faces():
+            return jsonify({
+                'success': False,
+                'message': 'No registered faces found'
+            }), 404
+        
+        args = request.args
+        camera_id = args.get('camera_id')
+        verbose = is_truthy(args.get('verbose', False))
+        max_frames = app.config['STREAM_MAX_FRAMES']
+        max_size = app.config['MAX_IMAGE_SIZE']
+        tracker = FaceTracker(
+            face_service,
+            min_frames=int(args.get('min_frames', app.config['STREAM_MIN_FRAMES'])),
+            detect_interval=app.config['STREAM_DETECT_INTERVAL'],
+            reencode_interval=app.config['STREAM_REENCODE_INTERVAL']
+        )
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'message': 'Invalid min_frames'
+        }), 400
+    
+    def line(event):
+        if camera_id is not None:
+            event['camera_id'] = camera_id
+        return json.dumps(event) + '\n'
+    
+    def generate():
+        try:
+            for index, frame in enumerate(read_frames(request.stream, max_size)):
+                if index >= max_frames:
+                    yield line({'event': 'error', 'message': f"Too many frames: maximum {max_frames} per stream"})
+                    break
+                
+                timings = {}
+                image_array = face_service.decode_image_bytes(frame, timings) if face_service.is_image(frame) else None
+                if image_array is None:
+                    yield line({'event': 'error', 'frame': index, 'message': 'Invalid image format'})
+                    continue
+                
+                for event in tracker.update(image_array, timings):
+                    # The tracker only counts decodable frames
+                    event['frame'] = index
+                    yield line(event)
+                if verbose:
+                    yield line({'event': 'frame', 'frame': index, 'tracks': tracker.describe(), 'timings_ms': timings})
+        except (ValueError, InferenceError) as e:
+            yield line({'event': 'error', 'message': str(e)})
+        except Exception as e:
+            logger.error(f"Error in recognize-stream endpoint: {traceback.format_exc()}")
+            yield line({'event': 'error', 'message': f'Server error: {str(e)}'})
+        
+        yield line(dict(event='end', **tracker.stats()))
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+@app.route('/recognize-batch', methods=['POST'])
+def recognize_batch():
+    """Recognize faces in many images at once (JSON base64 array or multipart files)"""
+    try:
+        ids = []
+        blobs = []
+        max_size = app.config['MAX_IMAGE_SIZE']
+        oversized = []
+        
+        if request.files:
+            top_k = parse_top_k(request.form.get('top_k', 1))
+            for file in request.files.getlist('photos'):
+                file.stream.seek(0, os.SEEK_END)
+                size = file.stream.tell()
+                file.stream.seek(0)
+                if size > max_size:
+                    oversized.append(len(blobs))
+                ids.append(file.filename)
+                blobs.append(None if size > max_size else file.read())
+        else:
+            data = request.get_json(silent=True)
+            if not isinstance(data, dict) or not isinstance(data.get('photos'), list):
+                return jsonify({
+                    'success': False,
+                    'message': 'Missing required field: photos (array)'
+                }), 400
+            
+            top_k = parse_top_k(data.get('top_k', 1))
+            for item in data['photos']:
+                # Items are either a base64 string or {"id": ..., "photo": ...}
+                photo = item.get('photo') if isinstance(item, dict) else item
+                ids.append(item.get('id') if isinstance(item, dict) else None)
+                if not isinstance(photo, str):
+                    blobs.append(None)
+                    continue
+                # Base64 inflates the payload by a third
+                if len(photo) * 3 // 4 > max_size:
+                    oversized.append(len(blobs))
+                    blobs.append(None)
+                    continue
+                blobs.append(face_service.decode_base64_data(photo) or None)
+        
+        if oversized:
+            return jsonify({
+                'success': False,
+                'message': f"Image too large: maximum {max_size} bytes (photos {', '.join(map(str, oversized[:10]))})"
+            }), 413
+        
+        if top_k is None:
+            return jsonify({
+                'success': False,
+                'message': 'top_k must be an integer'
+            }), 400
+        
+        if not blobs:
+            return jsonify({
+                'success': False,
+                'message': 'No photos provided'
+            }), 400
+        
+        if len(blobs) > app.config['BATCH_MAX_IMAGES']:
+            return jsonify({
+                'success': False,
+                'message': f"Too many photos: maximum {app.config['BATCH_MAX_IMAGES']} per batch"
+            }), 413
+        
+        results = face_service.recognize_batch(blobs, top_k, timings=g.timings)
+        
+        items = []
+        for index, (item_id, (user_id, confidence, message, candidates)) in enumerate(zip(ids, results)):
+            item = {
+                'index': index,
+                'id': item_id,
+                'success': user_id is not None,
+                'message': message,
+                'user_id': user_id if user_id is not None else 'unknown',
+                'confidence': round(confidence, 4)
+            }
+            if user_id is None:
+                item['reason'] = rejection_reason(message)
+            if top_k > 1:
+                item['candidates'] = candidates
+            items.append(item)
+        
+        response = {
+            'success': True,
+            'total': len(items),
+            'recognized': sum(1 for item in items if item['success']),
+            'results': items,
+            'recognized_at': datetime.now().isoformat()
+        }
+        if face_service.shards:
+            response['shards'] = face_service.shards.report()
+        return jsonify(response)
+        
+    except InferenceError as e:
+        logger.warning(f"recognize_batch rejected: {e}")
+        return jsonify({
+            'success': False,
+            'message': str(e)
+        }), e.status_code
+    except Exception as e:
+        logger.error(f"Error in recognize_batch endpoint: {traceback.format_exc()}")
+        return jsonify({
+            'success': False,
+            'message': f'Server error: {str(e)}'
+        }), 500
+
+@app.route('/enroll-jobs', methods=['POST'])
+def submit_enrollment_job():
+    """Queue many registrations at once; returns a job id to poll (JSON faces array or multipart)"""
+    try:
+        entries = []
+        
+        if request.files:
+            # Multipart: one `photos` part per face, named <user_id>.<ext>
+            replace = is_truthy(request.form.get('replace', False))
+            for file in request.files.getlist('photos'):
+                user_id = os.path.splitext(os.path.basename(file.filename or ''))[0]
+                entries.append((user_id, file.read(), replace))
+        else:
+            data = request.get_json(silent=True)
+            if not data or not isinstance(data.get('faces'), list):
+                return jsonify({
+                    'success': False,
+                    'message': 'Missing required field: faces (array of {user_id, photo})'
+                }), 400
+            
+            for face in data['faces']:
+                if not isinstance(face, dict) or 'user_id' not in face or 'photo' not in face:
+                    return jsonify({
+                        'success': False,
+                        'message': 'Each face needs user_id and photo'
+                    }), 400
+                image_data = face_service.decode_base64_data(face['photo'])
+                entries.append((face['user_id'], image_data or b'', is_truthy(face.get('replace', False))))
+        
+        if not entries:
+            return jsonify({
+                'success': False,
+                'message': 'No faces provided'
+            }), 400
+        
+        if len(entries) > app.config['ENROLL_MAX_FACES']:
+            return jsonify({
+                'success': False,
+                'message': f"Too many faces: maximum {app.config['ENROLL_MAX_FACES']} per job"
+            }), 413
+        
+        invalid = [user_id for user_id, _, _ in entries if user_id_error(user_id)]
+        if invalid:
+            return jsonify({
+                'success': False,
+                'message': f"{user_id_error(invalid[0])}: {', '.join(str(user_id) for user_id in invalid[:10])}"
+            }), 400
+        
+        oversized = [str(user_id) for user_id, image_data, _ in entries if len(image_data) > app.config['MAX_IMAGE_SIZE']]
+        if oversized:
+            return jsonify({
+                'success': False,
+                'message': f"Image too large for users: {', '.join(oversized[:10])}"
+            }), 413
+        
+        job = enrollment_queue.submit(entries)
+        if job is None:
+            return jsonify({
+                'success': False,
+                'message': 'Enrollment queue is full, please retry later'
+            }), 503
+        
+        return jsonify({
+            'success': True,
+            'job_id': job['job_id'],
+            'status': job['status'],
+            'total': job['total'],
+            'status_url': f"/enroll-jobs/{job['job_id']}"
+        }), 202
+        
+    except Exception as e:
+        logger.error(f"Error in submit_enrollment_job endpoint: {traceback.format_exc()}")
+        return jsonify({
+            'success': False,
+            'message': f'Server error: {str(e)}'
+        }), 500
+
+@app.route('/enroll-jobs/<job_id>', methods=['GET'])
+def get_enrollment_job(job_id):
+    """Progress of an enrollment job, with the outcome per user"""
+    job = enrollment_queue.status(job_id)
+    if job is None:
+        return jsonify({
+            'success': False,
+            'message': 'Enrollment job not found'
+        }), 404
+    
+    return jsonify({
+        'success': True,
+        'job': job
+    })
+
 @app.route('/status/<int:user_id>', methods=['GET'])
 def get_face_status(user_id):
     """Get face registration status for a specific user"""
@@ -374,6 +3808,129 @@ def get_face_status(user_id):
             'message': f'Server error: {str(e)}'
         }), 500
 
+@app.route('/status', methods=['GET', 'POST'])
+def get_face_statuses():
+    """Get face registration status for many users in one call
+    
+    User ids come from a JSON body {"user_ids": [1, 2, 3]} or a query
+    string ?user_ids=1,2,3; at most STATUS_MAX_USERS per call.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        user_ids = data.get('user_ids')
+        if user_ids is None:
+            user_ids = [value for value in request.args.get('user_ids', '').split(',') if value.strip()]
+        
+        if not isinstance(user_ids, list) or not user_ids:
+            return jsonify({
+                'success': False,
+                'message': 'Missing user_ids'
+            }), 400
+        
+        if len(user_ids) > app.config['STATUS_MAX_USERS']:
+            return jsonify({
+                'success': False,
+                'message': f"Too many user_ids: maximum {app.config['STATUS_MAX_USERS']} per call"
+            }), 400
+        
+        try:
+            user_ids = [int(user_id) for user_id in user_ids]
+        except (TypeError, ValueError):
+            return jsonify({
+                'success': False,
+                'message': 'user_ids must be integers'
+            }), 400
+        
+        if face_service.shards:
+            users = shard_statuses(user_ids)
+        else:
+            users = [{'user_id': user_id, **face_service.get_user_status(user_id)} for user_id in user_ids]
+        return jsonify({
+            'success': True,
+            'total': len(users),
+            'registered': sum(1 for user in users if user['registered']),
+            'users': users
+        })
+        
+    except Exception as e:
+        logger.error(f"Error in bulk status endpoint: {e}")
+        return jsonify({
+            'success': False,
+            'message': f'Server error: {str(e)}'
+        }), 500
+
+def shard_statuses(user_ids):
+    """Ask each shard for the status of its own users, keeping the requested order
+    
+    Users on a shard that did not answer are returned with `registered` null
+    and an `error`.
+    """
+    owned = {}
+    for user_id in user_ids:
+        owned.setdefault(face_service.shards.owner(user_id), []).append(user_id)
+    answers, failed = face_service.shards.scatter(
+        {shard: {'user_ids': ids} for shard, ids in owned.items()}, '/status'
+    )
+    
+    statuses = {}
+    for answer in answers.values():
+        statuses.update((user['user_id'], merge_last_match(user)) for user in answer['users'])
+    return [
+        statuses.get(user_id) or {
+            'user_id': user_id,
+            'registered': None,
+            'error': f"Shard {face_service.shards.owner(user_id)} unavailable"
+        }
+        for user_id in user_ids
+    ]
+
+@app.route('/match', methods=['POST'])
+def match_encodings():
+    """Match precomputed encodings against this node's gallery (called by a coordinator)
+    
+    Body: {"encodings": [[128 floats], ...], "top_k": 1, "exact": false}.
+    Answers raw distances per encoding so the coordinator can merge shards.
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        try:
+            encodings = np.asarray(data.get('encodings'), dtype=np.float64)
+        except (TypeError, ValueError):
+            encodings = None
+        if encodings is None or encodings.ndim != 2 or encodings.shape[1] != face_service.gallery.dimensions:
+            return jsonify({
+                'success': False,
+                'message': f'encodings must be a list of {face_service.gallery.dimensions}-dimensional vectors'
+            }), 400
+        top_k = parse_top_k(data.get('top_k', 1))
+        if top_k is None:
+            return jsonify({
+                'success': False,
+                'message': 'top_k must be an integer'
+            }), 400
+        
+        with timed(g.timings, 'match'):
+            matches = face_service.gallery.search_many(
+                encodings, top_k, is_truthy(data.get('exact', False)), face_service.aggregation
+            )
+        return jsonify({
+            'success': True,
+            'shard_id': face_service.shard_id,
+            'registered_faces': len(face_service.gallery),
+            'matches': [
+                [{'user_id': user_id, 'distance': distance} for user_id, distance in match]
+                for match in matches
+            ],
+            'timings_ms': g.timings
+        })
+        
+    except Exception as e:
+        logger.error(f"Error in match endpoint: {traceback.format_exc()}")
+        return jsonify({
+            'success': False,
+            'message': f'Server error: {str(e)}'
+        }), 500
+
 @app.route('/face/<int:user_id>', methods=['DELETE'])
 def delete_face(user_id):
     """Delete face data for a specific user"""
@@ -408,8 +3965,27 @@ def get_stats():
         return jsonify({
             'success': True,
             'stats': {
-                'registered_users': len(face_service.known_encodings),
-                'total_encodings': len(face_service.known_encodings),
+                'registered_users': len(face_service.gallery),
+                'total_encodings': face_service.gallery.template_count,
+                'gallery_index': {
+                    'type': face_service.gallery.index.name,
+                    'ready': face_service.gallery.index.ready,
+                    'nprobe': getattr(face_service.gallery.index, 'nprobe', None)
+                },
+                'quantization': face_service.gallery.quantizer.describe() if face_service.gallery.quantizer else None,
+                'detection': {
+                    'enroll': face_service.enroll_profile.describe(),
+                    'recognize': face_service.recognize_profile.describe()
+                },
+                'inference': face_service.inference.stats() if face_service.inference else None,
+                'embedding_cache': face_service.cache.stats() if face_service.cache else None,
+                'group_commit': face_service.committer.stats(),
+                'sharding': {
+                    'shard_id': face_service.shard_id,
+                    'shard_count': face_service.shard_count,
+                    'coordinator': face_service.shards.stats() if face_service.shards else None
+                },
+                'latency_ms': metrics.latency_summary(),
                 'recognition_tolerance': app.config['RECOGNITION_TOLERANCE'],
                 'data_directory': app.config['FACE_DATA_DIR'],
                 'server_info': {
@@ -427,6 +4003,29 @@ def get_stats():
             'message': f'Server error: {str(e)}'
         }), 500
 
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus text exposition of latency histograms, queue depth and gallery size"""
+    gallery = face_service.gallery
+    gauges = {
+        'gallery_users': ('Users with at least one face template', 'gauge', len(gallery)),
+        'gallery_templates': ('Live face templates in the gallery', 'gauge', gallery.template_count),
+        'gallery_tombstones': ('Deleted rows awaiting compaction', 'gauge', gallery.tombstones),
+        'uptime_seconds': ('Seconds since this worker started', 'gauge', round(time.time() - metrics.started_at, 3))
+    }
+    if face_service.inference:
+        inference = face_service.inference.stats()
+        gauges['inference_in_flight'] = ('Inference jobs running or queued', 'gauge', inference['in_flight'])
+        gauges['inference_capacity'] = ('Inference jobs admitted before 503', 'gauge',
+                                         inference['workers'] + inference['queue_size'])
+    if face_service.cache:
+        cache = face_service.cache.stats()
+        gauges['embedding_cache_hits_total'] = ('Embedding cache hits', 'counter', cache['hits'] + cache['shared_hits'])
+        gauges['embedding_cache_misses_total'] = ('Embedding cache misses', 'counter', cache['misses'])
+        gauges['embedding_cache_entries'] = ('Entries in the local embedding cache', 'gauge', cache['entries'])
+    
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
 @app.errorhandler(404)
 def not_found(error):
     return jsonify({
@@ -445,7 +4044,7 @@ if __name__ == '__main__':
     logger.info("Starting Face Recognition Server...")
     logger.info(f"Face data directory: {app.config['FACE_DATA_DIR']}")
     logger.info(f"Recognition tolerance: {app.config['RECOGNITION_TOLERANCE']}")
-    logger.info(f"Loaded {len(face_service.known_encodings)} face encodings")
+    logger.info(f"Loaded {len(face_service.gallery)} face encodings")
     
     # Run the Flask app
     app.run(
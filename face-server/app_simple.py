@@ -4,13 +4,15 @@ Simplified Face Recognition Server
 Alternative version without complex face_recognition library for Windows compatibility
 """
 
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 import os
 import base64
 import json
 import time
 import random
+import threading
+from itertools import islice
 from datetime import datetime
 
 app = Flask(__name__)
@@ -18,9 +20,63 @@ CORS(app)
 
 # Configuration
 FACES_DIR = 'faces'
+INDEX_FILE = os.path.join(FACES_DIR, 'index.json')
+FACES_PER_PAGE = 100
+MAX_FACES_PER_PAGE = 1000
 if not os.path.exists(FACES_DIR):
     os.makedirs(FACES_DIR)
 
+# employee_id -> {'name', 'registered_at', 'photo'}; photos are separate binary files
+face_index = {}
+index_lock = threading.Lock()
+
+def photo_extension(photo_bytes):
+    """File extension for the photo bytes, from their magic number"""
+    if photo_bytes.startswith(b'\xff\xd8'):
+        return 'jpg'
+    if photo_bytes.startswith(b'\x89PNG'):
+        return 'png'
+    return 'bin'
+
+def save_index():
+    """Atomically rewrite the index file; caller holds index_lock"""
+    tmp_file = f'{INDEX_FILE}.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(face_index, f)
+    os.replace(tmp_file, INDEX_FILE)
+
+def load_index():
+    """Load the index once, converting legacy <employee_id>.json files that embed the photo"""
+    if os.path.exists(INDEX_FILE):
+        with open(INDEX_FILE, 'r') as f:
+            face_index.update(json.load(f))
+    
+    legacy_files = [
+        name for name in os.listdir(FACES_DIR)
+        if name.endswith('.json') and name != os.path.basename(INDEX_FILE)
+    ]
+    for filename in legacy_files:
+        face_file = os.path.join(FACES_DIR, filename)
+        with open(face_file, 'r') as f:
+            face_data = json.load(f)
+        photo_bytes = base64.b64decode(face_data['photo'])
+        photo_file = f"{face_data['employee_id']}.{photo_extension(photo_bytes)}"
+        with open(os.path.join(FACES_DIR, photo_file), 'wb') as f:
+            f.write(photo_bytes)
+        face_index[str(face_data['employee_id'])] = {
+            'name': face_data['name'],
+            'registered_at': face_data['registered_at'],
+            'photo': photo_file
+        }
+    
+    if legacy_files:
+        save_index()
+        for filename in legacy_files:
+            os.remove(os.path.join(FACES_DIR, filename))
+        print(f"📦 Converted {len(legacy_files)} legacy face files")
+
+load_index()
+
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
@@ -47,22 +103,34 @@ def register_face():
         photo_data = data['photo']
         name = data.get('name', f'Employee {employee_id}')
         
+        # The id becomes a file name
+        if not str(employee_id) or str(employee_id).startswith('.') or any(c in str(employee_id) for c in '/\\'):
+            return jsonify({
+                'success': False,
+                'message': 'Invalid employee_id'
+            }), 400
+        
         # Remove data URL prefix if present
         if photo_data.startswith('data:image'):
             photo_data = photo_data.split(',')[1]
         
-        # Save photo as base64 encoded file
-        face_file = os.path.join(FACES_DIR, f'{employee_id}.json')
+        # Save the decoded photo as its own file; only metadata goes in the index
+        photo_bytes = base64.b64decode(photo_data)
+        photo_file = f'{employee_id}.{photo_extension(photo_bytes)}'
+        with open(os.path.join(FACES_DIR, photo_file), 'wb') as f:
+            f.write(photo_bytes)
+        
         face_data = {
-            'employee_id': employee_id,
             'name': name,
-            'photo': photo_data,
             'registered_at': datetime.now().isoformat(),
-            'version': '1.0'
+            'photo': photo_file
         }
-        
-        with open(face_file, 'w') as f:
-            json.dump(face_data, f)
+        with index_lock:
+            previous = face_index.pop(str(employee_id), None)
+            face_index[str(employee_id)] = face_data
+            save_index()
+        if previous and previous['photo'] != photo_file:
+            os.remove(os.path.join(FACES_DIR, previous['photo']))
         
         return jsonify({
             'success': True,
@@ -96,13 +164,10 @@ def recognize_face():
             photo_data = photo_data.split(',')[1]
         
         # Get all registered faces
-        registered_faces = []
-        for filename in os.listdir(FACES_DIR):
-            if filename.endswith('.json'):
-                face_file = os.path.join(FACES_DIR, filename)
-                with open(face_file, 'r') as f:
-                    face_data = json.load(f)
-                    registered_faces.append(face_data)
+        with index_lock:
+            registered_faces = [
+                dict(face_data, employee_id=employee_id) for employee_id, face_data in face_index.items()
+            ]
         
         if not registered_faces:
             return jsonify({
@@ -157,27 +222,38 @@ def recognize_face():
 
 @app.route('/faces', methods=['GET'])
 def list_faces():
-    """List all registered faces"""
+    """List registered faces one page at a time (?page=1&per_page=100), streamed from the index"""
     try:
-        faces = []
-        for filename in os.listdir(FACES_DIR):
-            if filename.endswith('.json'):
-                face_file = os.path.join(FACES_DIR, filename)
-                with open(face_file, 'r') as f:
-                    face_data = json.load(f)
-                    # Don't include photo data in list
-                    faces.append({
-                        'employee_id': face_data['employee_id'],
-                        'name': face_data['name'],
-                        'registered_at': face_data['registered_at']
-                    })
+        page = max(1, int(request.args.get('page', 1)))
+        per_page = min(MAX_FACES_PER_PAGE, max(1, int(request.args.get('per_page', FACES_PER_PAGE))))
         
-        return jsonify({
-            'success': True,
-            'total': len(faces),
-            'faces': faces
-        })
+        with index_lock:
+            total = len(face_index)
+            entries = list(islice(face_index.items(), (page - 1) * per_page, page * per_page))
         
+        def generate():
+            yield json.dumps({
+                'success': True,
+                'total': total,
+                'page': page,
+                'per_page': per_page,
+                'has_more': page * per_page < total
+            })[:-1] + ', "faces": ['
+            for i, (employee_id, face_data) in enumerate(entries):
+                yield (', ' if i else '') + json.dumps({
+                    'employee_id': employee_id,
+                    'name': face_data['name'],
+                    'registered_at': face_data['registered_at']
+                })
+            yield ']}'
+        
+        return Response(stream_with_context(generate()), mimetype='application/json')
+        
+    except ValueError:
+        return jsonify({
+            'success': False,
+            'message': 'page and per_page must be integers'
+        }), 400
     except Exception as e:
         return jsonify({
             'success': False,
@@ -188,15 +264,20 @@ def list_faces():
 def delete_face(employee_id):
     """Delete a registered face"""
     try:
-        face_file = os.path.join(FACES_DIR, f'{employee_id}.json')
+        with index_lock:
+            face_data = face_index.pop(str(employee_id), None)
+            if face_data is not None:
+                save_index()
         
-        if not os.path.exists(face_file):
+        if face_data is None:
             return jsonify({
                 'success': False,
                 'message': 'Face not found'
             }), 404
         
-        os.remove(face_file)
+        photo_file = os.path.join(FACES_DIR, face_data['photo'])
+        if os.path.exists(photo_file):
+            os.remove(photo_file)
         
         return jsonify({
             'success': True,
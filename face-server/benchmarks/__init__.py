@@ -0,0 +1,11 @@
+"""
+Benchmarks for the face recognition server
+
+    python -m benchmarks.matching   # gallery search cost at 1k/10k/100k users
+    python -m benchmarks.pipeline   # decode + detection cost per image resolution
+    python -m benchmarks.load       # concurrent HTTP load against a running server
+    python -m benchmarks.compare    # fail when results regress against a baseline
+
+Run from the face-server directory. Every suite prints (or writes with
+--output) a JSON document so results can be diffed and checked in CI.
+"""
@@ -0,0 +1,85 @@
+"""Shared helpers for the benchmark suites"""
+
+import json
+import os
+import platform
+import sys
+import time
+from datetime import datetime
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+
+def summarize(samples):
+    """Latency summary in milliseconds for a list of durations in seconds"""
+    if not samples:
+        return {'count': 0}
+    values = np.asarray(samples, dtype=np.float64) * 1000
+    p50, p95, p99 = np.percentile(values, [50, 95, 99])
+    return {
+        'count': len(values),
+        'mean_ms': round(float(values.mean()), 3),
+        'p50_ms': round(float(p50), 3),
+        'p95_ms': round(float(p95), 3),
+        'p99_ms': round(float(p99), 3),
+        'max_ms': round(float(values.max()), 3)
+    }
+
+
+def measure(fn, repeat, warmup=3):
+    """Call fn() `repeat` times after a warmup and return the durations in seconds"""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count()
+    }
+
+
+def synthetic_encodings(count, seed=0, dimensions=128):
+    """Random encodings with the spread of real dlib descriptors (~0.1 per component)"""
+    rng = np.random.default_rng(seed)
+    return rng.normal(0, 0.1, (count, dimensions))
+
+
+def synthetic_jpeg(width, height, seed=0, quality=85):
+    """A JPEG with smooth gradients plus noise, so it compresses like a photo"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 / width, y * 255 / height, (x + y) * 127 / (width + height)], axis=2)
+    image = np.clip(base + rng.normal(0, 12, base.shape), 0, 255).astype(np.uint8)
+    buffer = BytesIO()
+    Image.fromarray(image).save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+
+def write_results(suite, results, output=None, **parameters):
+    """Print the JSON document, or write it to `output`"""
+    document = {
+        'suite': suite,
+        'timestamp': datetime.now().isoformat(),
+        'environment': environment(),
+        'parameters': parameters,
+        'results': results
+    }
+    text = json.dumps(document, indent=2)
+    if output:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+        print(f"Wrote {len(results)} results to {output}", file=sys.stderr)
+    else:
+        print(text)
+    return document
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Benchmark regression check
+Compares a results file with a baseline from the same suite and exits with
+status 1 when any latency percentile got slower than the allowed margin
+
+Usage:
+    python -m benchmarks.compare baseline.json current.json
+    python -m benchmarks.compare baseline.json current.json --metric p95_ms --max-regression 0.25
+"""
+
+import argparse
+import json
+import sys
+
+# Fields that identify a case; everything else is a measurement
+KEY_FIELDS = ('benchmark', 'users', 'aggregation', 'batch', 'templates', 'index', 'dtype', 'quantize',
+              'rerank', 'image', 'resolution', 'profile', 'endpoint', 'encoding', 'concurrency')
+
+
+def case_key(result):
+    return tuple((field, result[field]) for field in KEY_FIELDS if field in result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fail when benchmark results regress against a baseline')
+    parser.add_argument('baseline', help='Baseline JSON results')
+    parser.add_argument('current', help='New JSON results from the same suite')
+    parser.add_argument('--metric', default='p50_ms', help='Latency field to compare (default: p50_ms)')
+    parser.add_argument('--max-regression', type=float, default=0.2,
+                        help='Allowed slowdown as a fraction (default: 0.2 = 20%%)')
+    parser.add_argument('--min-ms', type=float, default=0.05,
+                        help='Ignore cases faster than this in the baseline (timer noise)')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+
+    if baseline.get('suite') != current.get('suite'):
+        print(f"Suite mismatch: {baseline.get('suite')} vs {current.get('suite')}")
+        sys.exit(2)
+
+    reference = {case_key(result): result for result in baseline['results']}
+    regressions = 0
+    compared = 0
+    for result in current['results']:
+        before = reference.get(case_key(result), {}).get(args.metric)
+        after = result.get(args.metric)
+        if before is None or after is None or before < args.min_ms:
+            continue
+
+        compared += 1
+        change = (after - before) / before
+        label = ', '.join(f"{field}={value}" for field, value in case_key(result))
+        if change > args.max_regression:
+            regressions += 1
+            print(f"REGRESSION {label}: {args.metric} {before:.3f} -> {after:.3f} ({change:+.0%})")
+        else:
+            print(f"ok         {label}: {args.metric} {before:.3f} -> {after:.3f} ({change:+.0%})")
+
+    print(f"{compared} cases compared, {regressions} regressions over {args.max_regression:.0%}")
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+HTTP load driver
+Fires concurrent /recognize or /register-face requests at a running server
+and reports throughput, latency percentiles and status codes
+
+Usage:
+    python -m benchmarks.load --image face.jpg --endpoint recognize --concurrency 16 --requests 500
+    python -m benchmarks.load --image face.jpg --endpoint register-face --user-id-start 900000 --duration 30
+    python -m benchmarks.load --image face.jpg --encoding json --output load.json
+
+--image must be a photo with one clear face: every endpoint rejects a
+faceless image early, so a synthetic one would only time "No face detected".
+/register-face writes to the gallery: point it at a test instance, or use
+an unused --user-id-start range and delete those users afterwards. /verify
+checks the photo against --user-id-start, so register that user with the
+same photo first. Latency percentiles only cover 2xx responses; everything
+else is counted in `failed` and `statuses`.
+"""
+
+import argparse
+import base64
+import itertools
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from benchmarks.common import summarize, write_results
+
+
+def build_request(args, image, user_id):
+    """(url, kwargs) for one request in the selected encoding"""
+    url = f"{args.url.rstrip('/')}/{args.endpoint}"
+    fields = {'user_id': user_id} if args.endpoint in ('register-face', 'verify') else {}
+
+    if args.encoding == 'json':
+        fields['photo'] = 'data:image/jpeg;base64,' + base64.b64encode(image).decode()
+        return url, {'json': fields}
+    if args.encoding == 'multipart':
+        return url, {'data': fields, 'files': {'photo': ('photo.jpg', image, 'image/jpeg')}}
+    return url, {'params': fields, 'data': image, 'headers': {'Content-Type': 'image/jpeg'}}
+
+
+def run_load(args, image):
+    user_ids = itertools.count(args.user_id_start)
+    counter_lock = threading.Lock()
+    local = threading.local()
+    latencies = []
+    statuses = Counter()
+    deadline = time.perf_counter() + args.duration if args.duration else None
+    sent = itertools.count()
+
+    def worker():
+        # One keep-alive session per thread, like a kiosk
+        session = getattr(local, 'session', None) or requests.Session()
+        local.session = session
+        while True:
+            if deadline is None and next(sent) >= args.requests:
+                return
+            if deadline is not None and time.perf_counter() >= deadline:
+                return
+            if args.endpoint == 'register-face':
+                with counter_lock:
+                    user_id = next(user_ids)
+            else:
+                user_id = args.user_id_start
+            url, kwargs = build_request(args, image, user_id)
+            start = time.perf_counter()
+            try:
+                status = session.post(url, timeout=args.timeout, **kwargs).status_code
+            except requests.RequestException as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - start
+            with counter_lock:
+                # Rejections return early and would flatter the percentiles
+                if isinstance(status, int) and 200 <= status < 300:
+                    latencies.append(elapsed)
+                statuses[str(status)] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for future in [executor.submit(worker) for _ in range(args.concurrency)]:
+            future.result()
+    wall = time.perf_counter() - start
+
+    result = dict(
+        benchmark='http_load', endpoint=args.endpoint, encoding=args.encoding,
+        concurrency=args.concurrency, image_bytes=len(image),
+        wall_seconds=round(wall, 3),
+        throughput_rps=round(len(latencies) / wall, 2) if wall else 0.0,
+        succeeded=len(latencies),
+        failed=sum(statuses.values()) - len(latencies),
+        statuses=dict(statuses),
+        **summarize(latencies)
+    )
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent HTTP load test for the face server')
+    parser.add_argument('--url', default='http://localhost:5000', help='Server base URL')
+    parser.add_argument('--endpoint', default='recognize', choices=['recognize', 'register-face', 'verify'])
+    parser.add_argument('--image', required=True, help='Photo with one face to send')
+    parser.add_argument('--encoding', default='raw', choices=['raw', 'multipart', 'json'],
+                        help='Upload format (default: raw image/jpeg body)')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[8],
+                        help='Concurrent clients; several values run one round each')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per round (default: 200)')
+    parser.add_argument('--duration', type=float, help='Run each round for N seconds instead of --requests')
+    parser.add_argument('--user-id-start', type=int, default=900000,
+                        help='First user_id for register-face, the (registered) user_id for verify (default: 900000)')
+    parser.add_argument('--timeout', type=float, default=60, help='Per-request timeout in seconds')
+    parser.add_argument('--output', help='Write JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    with open(args.image, 'rb') as f:
+        image = f.read()
+
+    results = []
+    levels = args.concurrency
+    for concurrency in levels:
+        args.concurrency = concurrency
+        print(f"Load: {concurrency} clients -> {args.url}/{args.endpoint}", file=sys.stderr)
+        result = run_load(args, image)
+        if result['failed']:
+            print(f"  {result['failed']} of {result['failed'] + result['succeeded']} requests failed: {result['statuses']}",
+                  file=sys.stderr)
+        results.append(result)
+    args.concurrency = levels
+
+    write_results('load', results, args.output, **{
+        key: value for key, value in vars(args).items() if key not in ('output', 'image')
+    }, image=args.image)
+
+
+if __name__ == '__main__':
+    main()
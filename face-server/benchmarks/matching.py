@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Gallery matching benchmark
+Builds synthetic galleries of random 128-d encodings and measures the cost
+of the search behind recognize_face, /recognize-batch and /verify
+
+Usage:
+    python -m benchmarks.matching
+    python -m benchmarks.matching --sizes 1000 10000 100000 --templates 3
+    python -m benchmarks.matching --index ivf --output matching.json
+"""
+
+import argparse
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from app import FaceGallery, create_index
+from benchmarks.common import measure, summarize, synthetic_encodings, write_results
+
+
+def build_gallery(data_dir, users, templates, dtype, index, batch_size=10000):
+    gallery = FaceGallery(data_dir, dtype=dtype, index=index, index_min_size=0)
+    gallery.open()
+    encodings = synthetic_encodings(users, seed=users)
+    rng = np.random.default_rng(1)
+    now = time.time()
+    for start in range(0, users, batch_size):
+        items = []
+        for user in range(start, min(users, start + batch_size)):
+            for _ in range(templates):
+                # Templates of one user sit close to each other
+                items.append((user, encodings[user] + rng.normal(0, 0.02, 128), now, 1.0))
+        gallery.add_many(items)
+    return gallery, encodings
+
+
+def bench_size(users, args):
+    data_dir = tempfile.mkdtemp(prefix='face-bench-')
+    try:
+        start = time.perf_counter()
+        index = create_index(args.index, args.nlist, args.nprobe)
+        gallery, encodings = build_gallery(data_dir, users, args.templates, args.dtype, index)
+        build_seconds = time.perf_counter() - start
+
+        if args.index != 'exact':
+            start = time.perf_counter()
+            gallery.build_index()
+            index_seconds = time.perf_counter() - start
+        else:
+            index_seconds = 0.0
+
+        rng = np.random.default_rng(2)
+        targets = rng.integers(0, users, args.queries)
+        # Queries are noisy copies of enrolled faces, like a new photo of a known user
+        queries = encodings[targets] + rng.normal(0, 0.03, (args.queries, 128))
+        position = iter(range(10 ** 9))
+
+        def next_query():
+            return queries[next(position) % len(queries)]
+
+        results = []
+        for aggregation in args.aggregations:
+            samples = measure(lambda: gallery.search(next_query(), 1, False, aggregation), args.repeat)
+            results.append(dict(
+                benchmark='search', users=users, aggregation=aggregation, **summarize(samples)
+            ))
+
+        batch = queries[:args.batch_size]
+        samples = measure(lambda: gallery.search_many(batch, 1), max(3, args.repeat // 10))
+        summary = summarize(samples)
+        summary['per_query_ms'] = round(summary['p50_ms'] / len(batch), 3)
+        results.append(dict(benchmark='search_many', users=users, batch=len(batch), **summary))
+
+        samples = measure(lambda: gallery.verify(int(targets[0]), queries[0]), args.repeat)
+        results.append(dict(benchmark='verify', users=users, **summarize(samples)))
+
+        hits = sum(
+            1 for target, query in zip(targets, queries)
+            if gallery.search(query, 1)[0][0] == str(target)
+        )
+        for result in results:
+            result.update(
+                templates=args.templates, index=args.index, dtype=args.dtype,
+                recall_at_1=round(hits / len(queries), 4),
+                build_seconds=round(build_seconds, 3), index_seconds=round(index_seconds, 3)
+            )
+        return results
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark gallery matching on synthetic encodings')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='Gallery sizes in users (default: 1000 10000 100000)')
+    parser.add_argument('--templates', type=int, default=1, help='Templates per user (default: 1)')
+    parser.add_argument('--dtype', default='float64', choices=['float32', 'float64'])
+    parser.add_argument('--index', default='exact', choices=['exact', 'ivf'])
+    parser.add_argument('--nlist', type=int, default=256)
+    parser.add_argument('--nprobe', type=int, default=8)
+    parser.add_argument('--aggregations', nargs='+', default=['min', 'centroid'])
+    parser.add_argument('--queries', type=int, default=200, help='Distinct query encodings (default: 200)')
+    parser.add_argument('--repeat', type=int, default=200, help='Timed searches per case (default: 200)')
+    parser.add_argument('--batch-size', type=int, default=32, help='Queries per search_many call')
+    parser.add_argument('--output', help='Write JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    results = []
+    for users in args.sizes:
+        print(f"Benchmarking gallery of {users} users...", file=sys.stderr)
+        results.extend(bench_size(users, args))
+
+    write_results('matching', results, args.output, **{
+        key: value for key, value in vars(args).items() if key != 'output'
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Image pipeline benchmark
+Measures decode (base64 + JPEG draft decode), downscale, detection and
+encoding per image resolution for the enrollment and recognition profiles
+
+Usage:
+    python -m benchmarks.pipeline                         # synthetic images
+    python -m benchmarks.pipeline --images ./fixtures     # real photos (*.jpg, *.jpeg, *.png)
+    python -m benchmarks.pipeline --resolutions 640x480 4032x3024 --output pipeline.json
+"""
+
+import argparse
+import base64
+import os
+import shutil
+import sys
+import tempfile
+
+from PIL import Image
+
+from app import app, FaceRecognitionService, DetectionProfile, create_detector
+from benchmarks.common import measure, summarize, synthetic_jpeg, write_results
+
+
+def load_fixtures(args):
+    """(name, resolution, bytes) for every fixture image or synthetic resolution"""
+    if args.images:
+        fixtures = []
+        for name in sorted(os.listdir(args.images)):
+            if not name.lower().endswith(('.jpg', '.jpeg', '.png')):
+                continue
+            with open(os.path.join(args.images, name), 'rb') as f:
+                data = f.read()
+            with Image.open(os.path.join(args.images, name)) as image:
+                resolution = f"{image.width}x{image.height}"
+            fixtures.append((name, resolution, data))
+        return fixtures
+
+    fixtures = []
+    for resolution in args.resolutions:
+        width, height = (int(v) for v in resolution.lower().split('x'))
+        fixtures.append((f"synthetic-{resolution}.jpg", resolution, synthetic_jpeg(width, height)))
+    return fixtures
+
+
+def build_service(data_dir, args):
+    config = app.config
+    return FaceRecognitionService(
+        data_dir,
+        decode_max_size=args.decode_max_size,
+        detect_max_size=args.detect_max_size,
+        enroll_profile=DetectionProfile(
+            'enroll', create_detector(config['ENROLL_DETECTOR'], config['ENROLL_UPSAMPLE']),
+            config['ENROLL_JITTERS'], config['FACE_QUALITY_THRESHOLD']
+        ),
+        recognize_profile=DetectionProfile(
+            'recognize', create_detector(config['RECOGNIZE_DETECTOR'], config['RECOGNIZE_UPSAMPLE']),
+            config['RECOGNIZE_JITTERS'], config['RECOGNITION_QUALITY_THRESHOLD']
+        )
+    )
+
+
+def bench_fixture(service, name, resolution, data, repeat):
+    encoded = base64.b64encode(data).decode()
+    image_array = service.decode_image_bytes(data)
+    results = [
+        dict(benchmark='base64_decode', image=name, resolution=resolution, bytes=len(data),
+             **summarize(measure(lambda: service.decode_base64_data(encoded), repeat))),
+        dict(benchmark='image_decode', image=name, resolution=resolution, bytes=len(data),
+             decoded=f"{image_array.shape[1]}x{image_array.shape[0]}",
+             **summarize(measure(lambda: service.decode_image_bytes(data), repeat))),
+        dict(benchmark='downscale', image=name, resolution=resolution,
+             **summarize(measure(lambda: service.downscale_for_detection(image_array), repeat)))
+    ]
+
+    for profile in (service.recognize_profile, service.enroll_profile):
+        stages = {}
+        errors = set()
+
+        def detect():
+            timings = {}
+            _, _, _, error = service.detect_faces(image_array, timings, profile)
+            errors.add(error)
+            for stage, ms in timings.items():
+                stages.setdefault(stage, []).append(ms / 1000)
+
+        detect()
+        stages.clear()
+        total = measure(detect, repeat, warmup=0)
+        result = dict(
+            benchmark='detect_faces', image=name, resolution=resolution, profile=profile.name,
+            **profile.describe(), face_found=None in errors, **summarize(total)
+        )
+        result['stages'] = {stage: summarize(samples) for stage, samples in stages.items()}
+        results.append(result)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark image decode and face detection cost')
+    parser.add_argument('--images', help='Directory of fixture photos (default: synthetic JPEGs)')
+    parser.add_argument('--resolutions', nargs='+', default=['640x480', '1280x960', '1920x1440', '4032x3024'],
+                        help='Synthetic image sizes when --images is not given')
+    parser.add_argument('--decode-max-size', type=int, default=app.config['DECODE_MAX_SIZE'])
+    parser.add_argument('--detect-max-size', type=int, default=app.config['DETECT_MAX_SIZE'])
+    parser.add_argument('--repeat', type=int, default=20, help='Timed runs per image (default: 20)')
+    parser.add_argument('--output', help='Write JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix='face-bench-')
+    try:
+        service = build_service(data_dir, args)
+        results = []
+        for name, resolution, data in load_fixtures(args):
+            print(f"Benchmarking {name} ({resolution})...", file=sys.stderr)
+            results.extend(bench_fixture(service, name, resolution, data, args.repeat))
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    write_results('pipeline', results, args.output, **{
+        key: value for key, value in vars(args).items() if key != 'output'
+    })
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+"""
+Gallery quantization report
+Compares exact matching with the float16 and int8 first pass (plus exact
+re-ranking) on the same synthetic gallery: accuracy against the exact
+result, search latency and the memory each representation needs
+
+Usage:
+    python -m benchmarks.quantization
+    python -m benchmarks.quantization --sizes 10000 100000 --rerank 16 64 256
+    python -m benchmarks.quantization --dtype float32 --output quantization.json
+"""
+
+import argparse
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+from app import VectorQuantizer
+from benchmarks.common import measure, summarize, write_results
+from benchmarks.matching import build_gallery
+
+
+def bench_size(users, args):
+    data_dir = tempfile.mkdtemp(prefix='face-bench-')
+    try:
+        gallery, encodings = build_gallery(data_dir, users, args.templates, args.dtype, None)
+
+        rng = np.random.default_rng(2)
+        targets = rng.integers(0, users, args.queries)
+        queries = encodings[targets] + rng.normal(0, 0.03, (args.queries, 128))
+        exact = [gallery.search(query, args.top_k, exact=True) for query in queries]
+        exact_bytes = gallery.size * gallery.row_bytes
+
+        modes = [('exact', None)] + [
+            (kind, rerank) for kind in args.kinds for rerank in args.rerank
+        ]
+        results = []
+        for kind, rerank in modes:
+            gallery.quantizer = VectorQuantizer(kind, rerank=rerank) if rerank else None
+            # Reopening re-encodes every row into the new quantizer
+            gallery.open()
+
+            matches = [gallery.search(query, args.top_k) for query in queries]
+            position = iter(range(10 ** 9))
+            samples = measure(lambda: gallery.search(queries[next(position) % len(queries)], 1), args.repeat)
+
+            top1 = sum(1 for found, expected in zip(matches, exact) if found and found[0][0] == expected[0][0])
+            overlap = sum(
+                len({user for user, _ in found} & {user for user, _ in expected}) / max(1, len(expected))
+                for found, expected in zip(matches, exact)
+            )
+            hits = sum(1 for target, found in zip(targets, matches) if found and found[0][0] == str(target))
+            error = max(
+                (abs(a[1] - b[1]) for found, expected in zip(matches, exact) for a, b in zip(found, expected)
+                 if a[0] == b[0]),
+                default=0.0
+            )
+            packed = gallery.quantizer.nbytes if gallery.quantizer else 0
+            results.append(dict(
+                benchmark='quantization', users=users, templates=args.templates, dtype=args.dtype,
+                quantize=kind, rerank=rerank,
+                recall_at_1=round(hits / len(queries), 4),
+                top1_agreement=round(top1 / len(queries), 4),
+                top_k_overlap=round(overlap / len(queries), 4),
+                max_distance_error=round(float(error), 6),
+                exact_bytes=exact_bytes,
+                packed_bytes=packed,
+                bytes_per_template=round((packed or exact_bytes) / gallery.size, 2),
+                **summarize(samples)
+            ))
+        return results
+    finally:
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Report accuracy and memory of quantized gallery matching')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000],
+                        help='Gallery sizes in users (default: 10000 100000)')
+    parser.add_argument('--templates', type=int, default=1, help='Templates per user (default: 1)')
+    parser.add_argument('--dtype', default='float64', choices=['float32', 'float64'])
+    parser.add_argument('--kinds', nargs='+', default=['float16', 'int8'], choices=['float16', 'int8'])
+    parser.add_argument('--rerank', type=int, nargs='+', default=[64],
+                        help='Rows re-ranked exactly per query (default: 64)')
+    parser.add_argument('--top-k', type=int, default=5, help='Candidates compared with the exact result')
+    parser.add_argument('--queries', type=int, default=200, help='Distinct query encodings (default: 200)')
+    parser.add_argument('--repeat', type=int, default=200, help='Timed searches per case (default: 200)')
+    parser.add_argument('--output', help='Write JSON results to this file instead of stdout')
+    args = parser.parse_args()
+
+    results = []
+    for users in args.sizes:
+        print(f"Measuring quantization on a gallery of {users} users...", file=sys.stderr)
+        results.extend(bench_size(users, args))
+
+    write_results('quantization', results, args.output, **{
+        key: value for key, value in vars(args).items() if key != 'output'
+    })
+
+
+if __name__ == '__main__':
+    main()
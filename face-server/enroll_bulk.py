@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Bulk Enrollment Tool
+Encodes a directory or CSV manifest of photos on all cores and adds the
+templates to the gallery in one atomic commit. Running servers pick up the
+new gallery on their next request, no restart needed
+
+Photos are listed as <user_id>.<ext>, <user_id>/<any>.<ext> (several
+templates per user) or a CSV with `user_id,photo` columns (paths relative to
+the CSV). Encoding results are checkpointed as they arrive, so an interrupted
+run resumes where it stopped; the checkpoint is removed after the commit, and
+templates a user already has are skipped, so rerunning after a crash between
+the two does not add them twice.
+
+The app is imported only after the arguments are parsed, pointed at
+--data-dir and with STARTUP_MODE=manual: the parent never loads the dlib
+models or the server's default gallery, each encoding process loads the
+models once.
+
+Usage:
+    python enroll_bulk.py ./photos                  # enroll into FACE_DATA_DIR
+    python enroll_bulk.py manifest.csv --replace    # re-encode: replace existing templates
+    python enroll_bulk.py ./photos --workers 8      # encoding processes (default: all cores)
+    python enroll_bulk.py ./photos --restart        # ignore the checkpoint of an earlier run
+    python enroll_bulk.py ./photos --report report.json
+"""
+
+import os
+import csv
+import sys
+import json
+import time
+import hashlib
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from dotenv import load_dotenv
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+
+def read_manifest(source):
+    """List (user_id, path) pairs from a photo directory or a CSV manifest"""
+    if os.path.isfile(source):
+        base = os.path.dirname(os.path.abspath(source))
+        with open(source, newline='') as f:
+            return [
+                (row['user_id'].strip(), os.path.join(base, (row.get('photo') or row.get('path')).strip()))
+                for row in csv.DictReader(f)
+            ]
+
+    entries = []
+    for name in sorted(os.listdir(source)):
+        path = os.path.join(source, name)
+        if os.path.isdir(path):
+            entries.extend(
+                (name, os.path.join(path, photo)) for photo in sorted(os.listdir(path))
+                if photo.lower().endswith(IMAGE_EXTENSIONS)
+            )
+        elif name.lower().endswith(IMAGE_EXTENSIONS):
+            entries.append((os.path.splitext(name)[0], path))
+    return entries
+
+
+def encode_photo(entry):
+    """Worker entry point: encode one photo with the enrollment profile"""
+    # Already imported (and configured by main) in a forked worker, imported fresh when spawned
+    from app import face_service, load_face_recognition, shard_for, user_id_error
+    load_face_recognition()
+
+    user_id, path = entry
+    result = {'path': path, 'user_id': user_id, 'encoding': None, 'quality': None, 'error': None}
+    if user_id_error(user_id):
+        result['error'] = user_id_error(user_id)
+        return result
+    if not face_service.owns(user_id):
+        result['error'] = f"User belongs to shard {shard_for(user_id, face_service.shard_count)}"
+        return result
+
+    try:
+        with open(path, 'rb') as f:
+            image_data = f.read()
+        encoding, _, quality, error = face_service.process_image(image_data, None, face_service.enroll_profile)
+    except OSError:
+        error = "Could not read photo"
+
+    if error:
+        result['error'] = error
+    else:
+        result['encoding'] = [float(value) for value in encoding]
+        result['quality'] = quality
+    return result
+
+
+def load_checkpoint(path):
+    """Results of an interrupted run keyed by photo path; a torn last line is ignored"""
+    done = {}
+    if not os.path.exists(path):
+        return done
+    with open(path) as f:
+        for line in f:
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            done[result['path']] = result
+    return done
+
+
+def drop_stored(gallery, items):
+    """Items whose exact encoding the user already has; returns (new items, skipped count)"""
+    kept = []
+    for item in items:
+        rows = gallery.rows.get(str(item[0]))
+        if rows:
+            encoding = np.asarray(item[1], dtype=gallery.dtype)
+            if (np.asarray(gallery.matrix[rows]) == encoding).all(axis=1).any():
+                continue
+        kept.append(item)
+    return kept, len(items) - len(kept)
+
+
+def main():
+    load_dotenv()
+    parser = argparse.ArgumentParser(description='Encode many photos in parallel and enroll them in one commit')
+    parser.add_argument('source', help='Photo directory or CSV manifest (user_id,photo)')
+    parser.add_argument('--data-dir', default=os.getenv('FACE_DATA_DIR', './face_data'),
+                        help='Gallery directory (default: FACE_DATA_DIR)')
+    parser.add_argument('--replace', action='store_true',
+                        help="Replace the users' existing templates instead of adding to them")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Encoding processes (default: number of CPUs)')
+    parser.add_argument('--checkpoint', help='Checkpoint file (default: <data-dir>/jobs/bulk-<hash>.jsonl)')
+    parser.add_argument('--restart', action='store_true', help='Discard the checkpoint and encode everything again')
+    parser.add_argument('--report', help='Also write the throughput report as JSON to this file')
+    args = parser.parse_args()
+
+    # The app configures itself from the environment when first imported
+    os.environ['FACE_DATA_DIR'] = args.data_dir
+    os.environ['STARTUP_MODE'] = 'manual'
+    from app import app, FaceGallery, rejection_reason
+
+    entries = read_manifest(args.source)
+    print(f"Found {len(entries)} photos in {args.source}")
+
+    digest = hashlib.sha1(f"{os.path.abspath(args.source)}|{args.replace}".encode()).hexdigest()[:12]
+    checkpoint = args.checkpoint or os.path.join(args.data_dir, 'jobs', f"bulk-{digest}.jsonl")
+    os.makedirs(os.path.dirname(os.path.abspath(checkpoint)), exist_ok=True)
+    if args.restart and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    done = load_checkpoint(checkpoint)
+    pending = [entry for entry in entries if entry[1] not in done]
+    if done:
+        print(f"Resuming from {checkpoint}: {len(entries) - len(pending)} photos already encoded")
+
+    started = time.perf_counter()
+    with open(checkpoint, 'a') as f, ProcessPoolExecutor(max_workers=args.workers) as pool:
+        chunksize = max(1, min(16, len(pending) // (args.workers * 4)))
+        for count, result in enumerate(pool.map(encode_photo, pending, chunksize=chunksize), 1):
+            f.write(json.dumps(result) + '\n')
+            # Flushed per photo so an interrupted run loses at most the photos in flight
+            f.flush()
+            done[result['path']] = result
+            if count % 100 == 0:
+                elapsed = time.perf_counter() - started
+                print(f"  {count}/{len(pending)} encoded ({count / elapsed:.1f} images/sec)", file=sys.stderr)
+    encode_seconds = time.perf_counter() - started
+
+    results = [done[path] for _, path in entries if path in done]
+    items = [
+        (result['user_id'], result['encoding'], None, result['quality'])
+        for result in results if result['error'] is None
+    ]
+    failures = Counter(
+        rejection_reason(result['error']) or result['error']
+        for result in results if result['error'] is not None
+    )
+
+    gallery = FaceGallery(args.data_dir, dtype=app.config['GALLERY_DTYPE'])
+    skipped = 0
+    if not args.replace:
+        # A rerun after a crash between the commit and the checkpoint removal
+        items, skipped = drop_stored(gallery, items)
+    started = time.perf_counter()
+    added = gallery.bulk_add(
+        items, app.config['MAX_FACES_PER_USER'], app.config['TEMPLATE_REPLACE_POLICY'], args.replace
+    )
+    commit_seconds = time.perf_counter() - started
+    # The commit is durable; a crash before this line only means the next run re-adds the same templates
+    os.remove(checkpoint)
+
+    report = {
+        'photos': len(entries),
+        'encoded_this_run': len(pending),
+        'resumed': len(entries) - len(pending),
+        'succeeded': len(items) + skipped,
+        'failed': sum(failures.values()),
+        'failures': dict(failures.most_common()),
+        'already_stored': skipped,
+        'rows_added': added,
+        'workers': args.workers,
+        'encode_seconds': round(encode_seconds, 3),
+        'images_per_second': round(len(pending) / encode_seconds, 2) if encode_seconds and pending else None,
+        'commit_seconds': round(commit_seconds, 3),
+        'gallery_users': len(gallery),
+        'gallery_generation': gallery.generation
+    }
+
+    print(f"Encoded {len(pending)} photos in {encode_seconds:.1f}s "
+          f"({report['images_per_second'] or 0} images/sec on {args.workers} workers)")
+    print(f"Enrolled {len(items)} of {len(entries)} photos in one commit ({commit_seconds:.2f}s), "
+          f"gallery now holds {len(gallery)} users")
+    if skipped:
+        print(f"  skipped {skipped} templates already in the gallery")
+    for reason, count in failures.most_common():
+        print(f"  failed {count:>6}  {reason}")
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
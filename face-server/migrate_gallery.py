@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Gallery Migration Tool
+Imports legacy per-user <user_id>.npy / <user_id>_meta.json files into the
+memory-mapped gallery and optionally compacts it
+
+Usage:
+    python migrate_gallery.py                      # import into FACE_DATA_DIR
+    python migrate_gallery.py --source ./old_data  # import from another directory
+    python migrate_gallery.py --remove-legacy      # delete legacy files after import
+    python migrate_gallery.py --compact            # drop tombstoned rows
+    python migrate_gallery.py --force              # re-import users already in the gallery
+"""
+
+import os
+import argparse
+
+from app import app, FaceGallery
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Migrate face encodings into the gallery store')
+    parser.add_argument('--data-dir', default=app.config['FACE_DATA_DIR'],
+                        help='Gallery directory (default: FACE_DATA_DIR)')
+    parser.add_argument('--source', help='Directory holding legacy .npy files (default: --data-dir)')
+    parser.add_argument('--remove-legacy', action='store_true',
+                        help='Delete imported .npy and _meta.json files')
+    parser.add_argument('--compact', action='store_true', help='Compact the gallery after importing')
+    parser.add_argument('--force', action='store_true',
+                        help='Re-import users that are already in the gallery')
+    args = parser.parse_args()
+
+    source = args.source or args.data_dir
+    os.makedirs(args.data_dir, exist_ok=True)
+    gallery = FaceGallery(args.data_dir, dtype=app.config['GALLERY_DTYPE'])
+
+    legacy_files = [name for name in os.listdir(source) if name.endswith('.npy')]
+    print(f"Found {len(legacy_files)} legacy encodings in {source}")
+
+    imported = gallery.import_legacy_files(source, skip_existing=not args.force) if legacy_files else 0
+    print(f"Imported {imported} encodings, gallery now holds {len(gallery)} users")
+
+    if args.remove_legacy:
+        removed = 0
+        for name in legacy_files:
+            user_id = name[:-len('.npy')]
+            if user_id not in gallery:
+                continue
+            for path in (os.path.join(source, name), os.path.join(source, f"{user_id}_meta.json")):
+                if os.path.exists(path):
+                    os.remove(path)
+                    removed += 1
+        print(f"Removed {removed} legacy files")
+
+    if args.compact:
+        print(f"Compacted gallery, dropped {gallery.compact()} tombstoned rows")
+
+
+if __name__ == '__main__':
+    main()